@@ -15,6 +15,8 @@ import numpy as np
 from astropy.table import Table
 from TESSselfflatten import TESSflatten
 from bls import BLS
+from transit_search import stellar_bls_autopower
+from utility_belt import stellar_mass_radius
 
 def phase_fold_plot(t, lc, period, epoch, target_ID, save_path, title):
     """
@@ -91,7 +93,8 @@ plt.show()
 # Create periodogram
 durations = np.linspace(0.05, 0.2, 22) * u.day
 model = BLS(lc[:,0]*u.day, lc[:,1])
-results = model.autopower(durations, frequency_factor=5.0)
+stellar_mass, stellar_radius = stellar_mass_radius(target_ID)
+results = stellar_bls_autopower(model, durations, stellar_mass, stellar_radius, minimum_n_transit=3, frequency_factor=5.0)
 
 # Find the period and epoch of the peak
 index = np.argmax(results.power)
@@ -10,6 +10,7 @@ Script to more automatically analyse sensitivity analysis grid results
 import numpy as np
 import astropy
 from astropy.table import Table
+from recovery_classifier import classify_recoveries, match_period
 
 save_path = '/Users/mbattley/Documents/PhD/Papers/Detrending of young stars - TESS 1-5/Paper corrections/Grid2_sensitivity/'
 sector = 1
@@ -19,27 +20,15 @@ sector_list = [1,2,3,4,5]
 for sector in sector_list:
     table_data = Table.read(save_path + "Sensitivity_analysis_S{}_grid_cleaned.csv".format(sector) , format='ascii.csv', guess = False)
     
-    table_data['Recovered'] = 0
+    injected = np.asarray(table_data['Injected Period'], dtype=float)
+    recovered = classify_recoveries(injected, [table_data['Max Period'], table_data['2nd highest period'], table_data['3rd Highest Period']])
+    # Wider tolerance for 14 day injections
+    recovered |= (injected == 14) & match_period(table_data['Max Period'], injected, tolerance = 0.2)
     
-    for i in range(len(table_data['Target ID'])):
-        if np.abs(table_data['Max Period'][i] - table_data['Injected Period'][i]) < 0.02:
-            table_data['Recovered'][i] = table_data['Injected Period'][i]
-        elif np.abs(table_data['Max Period'][i]-table_data['Injected Period'][i]*2) <0.02:
-            table_data['Recovered'][i] = table_data['Injected Period'][i]
-        elif np.abs(table_data['Max Period'][i]-table_data['Injected Period'][i]*0.5) <0.02:
-            table_data['Recovered'][i] = table_data['Injected Period'][i]
-        elif np.abs(table_data['2nd highest period'][i]-table_data['Injected Period'][i]) <0.02:
-            table_data['Recovered'][i] = table_data['Injected Period'][i]
-        elif np.abs(table_data['3rd Highest Period'][i]-table_data['Injected Period'][i]) <0.02:
-            table_data['Recovered'][i] = table_data['Injected Period'][i]
-        elif table_data['Injected Period'][i] == 14:
-            if np.abs(table_data['Max Period'][i] - table_data['Injected Period'][i]) < 0.2:
-                table_data['Recovered'][i] = table_data['Injected Period'][i]
-        
-        # Fixes J0638-5604 due to inconvenient rotation period
-        if table_data['Target ID'][i] == 'J0638-5604':
-            table_data['Recovered'][i] = 0
-        
+    # Fixes J0638-5604 due to inconvenient rotation period
+    recovered &= np.asarray(table_data['Target ID']) != 'J0638-5604'
+    
+    table_data['Recovered'] = np.where(recovered, table_data['Injected Period'], 0).astype(int)
             
     #print(table_data['Recovered'])
     
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:26:09 2026
+bls_significance.py
+
+Bootstrap false-alarm probabilities for BLS detections.
+
+The residual light curve is scrambled n_trials times (permuted, resampled or
+block-shuffled) and each scrambled lc is searched with the same period grid
+and trial durations as the real search. The signal detection efficiency (SDE)
+of each candidate is then compared against the distribution of the highest
+SDE found in the scrambled lcs.
+
+Trials are shared out between a pool of worker processes. Each worker works
+through the period grid in chunks, works out which phase bin every point falls
+in once per chunk and then reuses these for all of its trials, so each trial
+only costs the binned sums and the binned BLS itself.
+
+@author: mbattley
+"""
+
+import numpy as np
+import multiprocessing as multip
+from periodogram_state import phase_bin_indices, binned_sums, binned_bls
+from transit_search import _strip_unit
+
+def scramble_flux(flux, rng, method = 'permute', block_size = 48):
+    """
+    Returns one scrambled copy of the flux array
+    'permute' shuffles the points, 'bootstrap' resamples them with replacement
+    and 'block' shuffles the order of blocks of block_size consecutive points,
+    which keeps any correlated noise on shorter timescales
+    """
+    if method == 'permute':
+        return rng.permutation(flux)
+    elif method == 'bootstrap':
+        return flux[rng.integers(0, len(flux), len(flux))]
+    elif method == 'block':
+        n_blocks = int(np.ceil(len(flux)/block_size))
+        blocks = np.array_split(flux, n_blocks)
+        order = rng.permutation(n_blocks)
+        return np.concatenate([blocks[i] for i in order])
+    else:
+        raise ValueError("method must be 'permute', 'bootstrap' or 'block'")
+
+def _bootstrap_worker(args):
+    """
+    Runs the given trials and returns the highest SDE found in each
+    """
+    (time, flux, w, periods, durations, n_bins, t_ref, m_star, r_star, seeds, method, block_size, chunk_size) = args
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    trial_wy = np.array([w*scramble_flux(flux, rng, method, block_size) for rng in rngs])
+    W = np.sum(w)
+    power_max = np.full(len(seeds), -np.inf)
+    power_sum = np.zeros(len(seeds))
+    power_sum2 = np.zeros(len(seeds))
+
+    for start in range(0, len(periods), chunk_size):
+        p = periods[start:start+chunk_size]
+        flat = phase_bin_indices(time, p, n_bins, t_ref)
+        sum_w = binned_sums(flat, w, len(p), n_bins)
+        for i, wy in enumerate(trial_wy):
+            sum_wy = binned_sums(flat, wy, len(p), n_bins)
+            power = binned_bls(p, sum_w, sum_wy, W, np.sum(wy), t_ref, durations, m_star, r_star).power
+            power_max[i] = max(power_max[i], np.max(power))
+            power_sum[i] += np.sum(power)
+            power_sum2[i] += np.sum(power**2)
+
+    n = len(periods)
+    mean = power_sum/n
+    std = np.sqrt(power_sum2/n - mean**2)
+    return (power_max - mean)/std
+
+def bootstrap_bls_fap(time, flux, candidates, periods, durations, n_trials = 100, n_bins = 200, t_ref = None, flux_err = None, method = 'permute', block_size = None, n_workers = None, seed = 42, m_star = np.nan, r_star = np.nan, chunk_size = 500):
+    """
+    Adds bootstrap false-alarm probabilities ('FAP') and the signal detection
+    efficiency ('SDE') to a table of candidates from extract_candidates
+
+    The real lc is searched with the same binned BLS as the trials, and each
+    candidate's SDE is read off at the strongest binned peak within a few grid
+    points of its period. FAP = (n + 1)/(n_trials + 1), where n is the number
+    of trials whose highest SDE is at least the candidate's.
+    n.b. block_size (only used with method = 'block') is in days
+    """
+    time = np.asarray(getattr(time, 'value', time), dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    periods, _ = _strip_unit(periods)
+    durations, _ = _strip_unit(durations)
+    if flux_err is None:
+        w = np.ones(len(time))
+    else:
+        w = 1/np.asarray(flux_err, dtype=float)**2
+    if t_ref is None:
+        t_ref = time[0]
+    if block_size is None:
+        block_size = 1.
+    block_points = max(int(round(block_size/np.median(np.diff(time)))), 1)
+    if n_workers is None:
+        n_workers = multip.cpu_count()
+
+    # Work relative to the mean so the binned sums stay well conditioned
+    flux = flux - np.average(flux, weights=w)
+
+    # Real lc, searched in exactly the same way as the trials
+    W = np.sum(w)
+    observed = np.zeros(len(periods))
+    for start in range(0, len(periods), chunk_size):
+        p = periods[start:start+chunk_size]
+        flat = phase_bin_indices(time, p, n_bins, t_ref)
+        observed[start:start+len(p)] = binned_bls(p, binned_sums(flat, w, len(p), n_bins), binned_sums(flat, w*flux, len(p), n_bins),
+                                                  W, np.sum(w*flux), t_ref, durations, m_star, r_star).power
+    observed_sde = (observed - np.mean(observed))/np.std(observed)
+
+    seeds = seed + np.arange(n_trials)
+    jobs = [(time, flux, w, periods, durations, n_bins, t_ref, m_star, r_star, worker_seeds, method, block_points, chunk_size)
+            for worker_seeds in np.array_split(seeds, n_workers) if len(worker_seeds) > 0]
+    if len(jobs) > 1:
+        pool = multip.Pool(len(jobs))
+        trial_sde = np.concatenate(pool.map(_bootstrap_worker, jobs))
+        pool.close()
+        pool.join()
+    else:
+        trial_sde = np.concatenate([_bootstrap_worker(job) for job in jobs])
+
+    candidate_periods, _ = _strip_unit(candidates['period'])
+    nearest = np.argmin(np.abs(periods[None,:] - candidate_periods[:,None]), axis=1)
+    window = np.arange(-5, 6)
+    nearby = (nearest[:,None] + window[None,:]).clip(0, len(periods)-1)
+    sde = np.max(observed_sde[nearby], axis=1)
+    n_exceed = np.sum(trial_sde[None,:] >= sde[:,None], axis=1)
+
+    candidates['SDE'] = sde
+    candidates['FAP'] = (n_exceed + 1.)/(n_trials + 1.)
+    return candidates
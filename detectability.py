@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:30:14 2026
+detectability.py
+
+Analytic pre-screening of injection grids.
+
+The combined differential photometric precision (CDPP) of a detrended lc is
+the scatter of its running mean over a transit duration. With cumulative
+sums every running mean of a given length costs O(1), so the CDPP for any
+duration is O(N). For a planet of given period and radius ratio, the
+expected SNR is then depth/CDPP(duration)*sqrt(number of transits
+observed). A logistic curve in this SNR, calibrated against past injection
+results, predicts the chance of recovery, so injection cells that are
+certain recoveries or certain misses can be skipped.
+
+@author: mbattley
+"""
+
+import numpy as np
+from scipy import optimize
+from astropy.table import Table
+from lowess_detrend import lowess_baseline, localized_lowess_detrend
+from transit_search import scaled_semi_major_axis
+
+def cdpp(time, flux, durations, max_gap_fraction = 0.5):
+    """
+    CDPP (relative flux) of a detrended lc for each duration (days): the
+    robust standard deviation of the running mean over that duration.
+    Windows spanning a gap longer than max_gap_fraction of the duration are
+    left out.
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    durations = np.atleast_1d(np.asarray(getattr(durations, 'value', durations), dtype=float))
+    cadence = np.median(np.diff(time))
+    residual = flux/np.median(flux) - 1
+    cum_flux = np.concatenate(([0.], np.cumsum(residual)))
+    result = np.full(len(durations), np.nan)
+    for i, duration in enumerate(durations):
+        n = max(int(round(duration/cadence)), 1)
+        if n > len(time):
+            continue
+        means = (cum_flux[n:] - cum_flux[:-n])/n
+        # n.b. The span of a full window is (n-1) cadences
+        span = time[n-1:] - time[:len(time)-n+1]
+        means = means[span < (n - 1)*cadence + max_gap_fraction*duration]
+        if len(means) > 1:
+            result[i] = 1.4826*np.median(np.abs(means - np.median(means)))
+    return result
+
+def transit_duration(period, rp, m_star = np.nan, r_star = np.nan, a = None):
+    """
+    Total duration (days) of a central transit on a circular orbit; a (in
+    stellar radii) from Kepler's third law if not given, 17 if unknown
+    """
+    period = np.asarray(period, dtype=float)
+    if a is None:
+        a = scaled_semi_major_axis(period, m_star, r_star)
+    a = np.where(np.isfinite(a), a, 17.)
+    return period/np.pi*np.arcsin(np.minimum((1 + np.asarray(rp, dtype=float))/a, 1.))
+
+def expected_snr(time, flux, periods, rps, m_star = np.nan, r_star = np.nan, n_durations = 50):
+    """
+    Expected transit SNR for planets with the given periods and radius ratios
+    (arrays of any matching shape) in a detrended lc, from depth rp**2, the
+    CDPP over the transit duration and the expected number of transits in
+    the observed time
+    n.b. The CDPP is evaluated on a log grid of n_durations durations and
+         interpolated, so a whole grid costs n_durations O(N) passes
+    """
+    time = np.asarray(time, dtype=float)
+    periods, rps = np.broadcast_arrays(np.asarray(periods, dtype=float), np.asarray(rps, dtype=float))
+    durations = transit_duration(periods, rps, m_star, r_star)
+    cadence = np.median(np.diff(time))
+    grid = np.geomspace(max(np.min(durations), cadence), max(np.max(durations), 2*cadence), n_durations)
+    noise = np.interp(np.log(durations), np.log(grid), cdpp(time, flux, grid))
+    # Observed time, counting each cadence once, over the period
+    n_transits = len(time)*cadence/periods
+    return rps**2/noise*np.sqrt(np.maximum(n_transits, 1.))
+
+def calibrate_detectability(snr, recovered):
+    """
+    Fits P(recovered) = 1/(1 + exp(-(snr - snr_50)/width)) to past injection
+    results by maximum likelihood; returns (snr_50, width)
+    """
+    snr = np.asarray(snr, dtype=float)
+    recovered = np.asarray(recovered, dtype=bool)
+    good = np.isfinite(snr)
+    snr = snr[good]
+    recovered = recovered[good]
+
+    def neg_log_likelihood(theta):
+        z = (snr - theta[0])/np.exp(theta[1])
+        return np.sum(np.logaddexp(0, -z)[recovered]) + np.sum(np.logaddexp(0, z)[~recovered])
+
+    start = [np.median(snr), np.log(max(np.std(snr)/4, 1e-3))]
+    fit = optimize.minimize(neg_log_likelihood, start, method='Nelder-Mead')
+    return fit.x[0], np.exp(fit.x[1])
+
+def recovery_probability(snr, snr_50 = 7.3, width = 1.):
+    """
+    Predicted chance of recovery at a given expected SNR
+    """
+    return 1/(1 + np.exp(-(np.asarray(snr, dtype=float) - snr_50)/width))
+
+def screen_tasks(tasks, stars, snr_50 = 7.3, width = 1., certainty = 0.99, detrending = 'lowess_partial', n_bins = 30, pipeline = '2min'):
+    """
+    Splits an injection grid (from injection_recovery.injection_grid) into
+    the tasks worth running and those predicted with at least 'certainty'
+    to be recovered or missed. stars maps target_ID -> prepare_star output;
+    each lc is lowess detrended as in run_injection first, reusing (or
+    adding) the baseline cached under star['baselines']. The screened-out
+    tasks get their predicted probability and outcome.
+    """
+    snr = np.full(len(tasks), np.nan)
+    for target_ID in np.unique(tasks['target_ID']):
+        rows = np.where(tasks['target_ID'] == target_ID)[0]
+        star = stars[target_ID]
+        baselines = star.setdefault('baselines', {})
+        key = (detrending, n_bins, pipeline)
+        if key not in baselines:
+            baselines[key] = lowess_baseline(star['time'], star['flux'], detrending, n_bins, pipeline)
+        residual_flux, _, t_kept = localized_lowess_detrend(baselines[key], star['flux'], np.zeros(len(star['time']), dtype=bool))
+        snr[rows] = expected_snr(t_kept, residual_flux, np.asarray(tasks['period'])[rows], np.asarray(tasks['rp'])[rows],
+                                 star.get('m_star', np.nan), star.get('r_star', np.nan))
+    probability = recovery_probability(snr, snr_50, width)
+    decided = (probability >= certainty) | (probability <= 1 - certainty)
+    to_run = tasks[~decided]
+    predicted = Table(tasks[decided])
+    predicted['expected_snr'] = snr[decided]
+    predicted['probability'] = probability[decided]
+    predicted['recovered'] = probability[decided] >= certainty
+    return to_run, predicted
@@ -27,6 +27,7 @@ from wotan import flatten
 from astropy.io import ascii
 from astropy.table import Table
 from scipy import interpolate
+from utility_belt import acf_rotation_period
 
 def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending methods/Smoothing/lowess/Injected Transits/HIP 1113/', sector = 1, target_ID_list = single_target_ID, pipeline = '2min', multi_sector = False, use_TESSflatten = False, use_peak_cut = False, binned = False, transit_mask = False, injected_planet = 'user_defined', injected_rp = 0.1, injected_per = 8.0, detrending = 'lowess_partial', single_target_ID = ['HIP 1113']):
     for target_ID in target_ID_list:
@@ -89,15 +90,9 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
             p_rot = 1/freq_rot
             print('Rotation Period = {:.3f}d'.format(p_rot))
             
-            # From BLS
-            durations = np.linspace(0.05, 1, 22) * u.day
-            model = BoxLeastSquares(lc_30min.time*u.day, normalized_flux)
-    #        model = BLS(lc_30min.time*u.day, BLS_flux)
-            results = model.autopower(durations, frequency_factor=1.0)
-            rot_index = np.argmax(results.power)
-            rot_period = results.period[rot_index]
-            rot_t0 = results.transit_time[rot_index]
-            print("Rotation Period from BLS of original = {}d".format(rot_period))
+            # From ACF (n.b. replaces the BLS of the original lc, which was only used for rot_period)
+            rot_period, rot_acf_height, rot_period_err = acf_rotation_period(lc_30min.time, normalized_flux)
+            print("Rotation Period from ACF of original = {:.3f} +/- {:.3f}d (ACF peak height {:.2f})".format(rot_period, rot_period_err, rot_acf_height))
             
             ########################### batman stuff ######################################
             if injected_planet != False:
@@ -34,6 +34,13 @@ from scipy import interpolate
 from astropy import constants as const
 from remove_tess_systematics import clean_tess_lc
 from fits_handling import get_lc_from_fits
+from transit_search import stellar_bls_autopower, extract_candidates, refine_candidates, vet_candidates, single_transit_search
+from stellar_params import load_catalog, EXO_ARCHIVE_FILE, EXO_ARCHIVE_KEYS
+from utility_belt import stellar_mass_radius, pdm_rotation_period, search_cadence, bin_by_time
+from bls_significance import bootstrap_bls_fap
+from transit_templates import cached_light_curve
+from planet_population import population_params
+from periodogram_state import load_periodogram_state, save_periodogram_state, add_ls_sector, add_bls_sector, ls_power_from_state, bls_power_from_state
 
 ######################## Set font sizes ####################
 SMALL_SIZE = 8
@@ -51,7 +58,15 @@ plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 ############################################################
 
 
-def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending methods/Smoothing/lowess/QLP lcs/', sector = 1, target_ID_list = [], pipeline = '2min', multi_sector = False, use_TESSflatten = False, use_peak_cut = False, binned = False, transit_mask = False, injected_planet = 'user_defined', injected_rp = 0.1, injected_per = 8.0, detrending = 'lowess_partial', single_target_ID = ['HIP 1113'], n_bins = 30):
+def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending methods/Smoothing/lowess/QLP lcs/', sector = 1, target_ID_list = [], pipeline = '2min', multi_sector = False, use_TESSflatten = False, use_peak_cut = False, binned = False, transit_mask = False, injected_planet = 'user_defined', injected_rp = 0.1, injected_per = 8.0, detrending = 'lowess_partial', single_target_ID = ['HIP 1113'], n_bins = 30, periodogram_state = False, bootstrap_trials = 0, search_method = 'BLS', tls_threads = None, search_binning = False, injected_population = None, population_index = 0):
+    # n.b. periodogram_state = directory of per-target periodogram accumulators for multi-sector runs (one state per
+    #                          pipeline/detrending setup; not used or updated when a planet is injected)
+    #      bootstrap_trials = number of scrambled-lc BLS trials used to give each candidate a FAP (0 to skip)
+    #      search_method = 'BLS' or 'TLS'; tls_threads = number of threads for TLS (default all cores)
+    #      search_binning = cadence (days) to bin to for the LS/BLS searches, 'auto' to set it from the shortest
+    #                       trial duration (e.g. for 2min data), or False to search at full cadence
+    #      injected_planet = 'population' injects planet population_index of injected_population (a batch from
+    #                        planet_population.sample_population), so campaigns are reproducible however they are split
     for target_ID in target_ID_list:
         print(target_ID)
         try:
@@ -65,6 +80,7 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
                 lc_30min.time = clean_time
                 lc_30min.flux = clean_flux
                 lc_30min.flux_err = clean_flux_err
+                sector_edges = [(multi_sector[0], np.min(clean_time), np.max(clean_time))]
                 for sector_num in multi_sector[1:]:
                     sap_lc_new, pdcsap_lc_new = two_min_lc_download(target_ID, sector_num, from_file = False)
                     lc_30min_new = pdcsap_lc_new
@@ -75,6 +91,7 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
                     lc_30min_new.flux = clean_flux
                     lc_30min_new.flux_err = clean_flux_err
                     lc_30min = lc_30min.append(lc_30min_new)
+                    sector_edges.append((sector_num, np.min(clean_time), np.max(clean_time)))
 #                    lc_30min.flux = lc_30min.flux.append(lc_30min_new.flux)
 #                    lc_30min.time = lc_30min.time.append(lc_30min_new.time)
 #                    lc_30min.flux_err = lc_30min.flux_err.append(lc_30min_new.flux_err)
@@ -144,9 +161,35 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
 #            normalized_flux = np.array(lc_30min.flux)/np.median(lc_30min.flux)
             normalized_flux = lc_30min.flux
 #            target_ID = 'HD 42270'
+            # BLS trial durations, also used to set the search cadence
+            durations = np.linspace(0.05, 1, 100) * u.day
+            # Cadence for the periodogram searches
+            if search_binning == 'auto':
+                search_cad = search_cadence(durations.min().value) # Shortest BLS trial duration
+            else:
+                search_cad = search_binning
+            if search_binning != False:
+                ls_time, ls_flux, ls_err = bin_by_time(lc_30min.time, normalized_flux, search_cad)
+            else:
+                ls_time, ls_flux = lc_30min.time, normalized_flux
             # From Lomb-Scargle
-            freq = np.arange(0.04,4.1,0.00001)
-            power = LombScargle(lc_30min.time, normalized_flux).power(freq)
+            # n.b. Injection runs never use the stored state, which must only hold the star's own (uninjected) lc
+            use_state = periodogram_state != False and multi_sector != False and injected_planet == False
+            if use_state:
+                # Only sectors not already in the stored accumulators are added
+                state_settings = {'pipeline':pipeline, 'detrending':detrending, 'n_bins':n_bins, 'use_TESSflatten':use_TESSflatten,
+                                  'use_peak_cut':use_peak_cut, 'transit_mask':transit_mask, 'search_binning':search_binning}
+                state_filename = periodogram_state + '{}_{}_{}_{}_periodogram_state.pkl'.format(target_ID, pipeline, detrending, n_bins)
+                # n.b. A new state's BLS period grid is sized for the baseline of the sectors loaded now
+                state = load_periodogram_state(state_filename, settings = state_settings, baseline = np.max(lc_30min.time) - np.min(lc_30min.time))
+                for sector_num, t_start, t_end in sector_edges:
+                    in_sector = (ls_time >= t_start) & (ls_time <= t_end)
+                    add_ls_sector(state, sector_num, ls_time[in_sector], np.array(ls_flux)[in_sector])
+                freq = state['freq']
+                power = ls_power_from_state(state)
+            else:
+                freq = np.arange(0.04,4.1,0.00001)
+                power = LombScargle(ls_time, ls_flux).power(freq)
             ls_fig = plt.figure()
             plt.plot(freq, power, c='k', linewidth = 1)
             plt.xlabel('Frequency')
@@ -160,6 +203,15 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
             p_rot = 1/freq_rot
             print('Rotation Period = {:.3f}d'.format(p_rot))
             
+            # From PDM, as a check on eclipsing binaries and non-sinusoidal rotators
+            # n.b. Run on a 30 min binned copy: PDM at 2 min cadence costs ~10x the time and memory for the same period
+            if np.median(np.diff(lc_30min.time)) < 0.02:
+                pdm_time, pdm_flux, _ = bin_by_time(lc_30min.time, normalized_flux, 30./1440)
+            else:
+                pdm_time, pdm_flux = lc_30min.time, normalized_flux
+            p_pdm, theta_pdm = pdm_rotation_period(pdm_time, pdm_flux)
+            print('Rotation Period from PDM = {:.3f}d (theta = {:.3f})'.format(p_pdm, theta_pdm))
+            
             if p_rot <8:
                 n_bins = 20
             
@@ -173,6 +225,12 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
 #            rot_t0 = results.transit_time[rot_index]
 #            print("Rotation Period from BLS of original = {}d".format(rot_period))
             
+            ######################### Stellar parameters ##################################
+            # n.b. Used both for injections and to bound the BLS trial durations
+            stellar_mass, stellar_radius = stellar_mass_radius(target_ID, filename = "BANYAN_XI-III_members_with_TIC.csv")
+            m_star = stellar_mass*m_Sun
+            r_star = stellar_radius*r_Sun*1000
+            
             ########################### batman stuff ######################################
             if injected_planet != False:
         #        type_of_planet = 'Hot Jupiter'
@@ -182,10 +240,6 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
 #                params.t0 = -13.085
                 params.per = 8.0
                 params.rp = 0.1
-                table_data = Table.read("BANYAN_XI-III_members_with_TIC.csv" , format='ascii.csv')
-                i = list(table_data['main_id']).index(target_ID)
-                m_star = table_data['Stellar Mass'][i]*m_Sun
-                r_star = table_data['Stellar Radius'][i]*r_Sun*1000
                 params.a = (((G*m_star*(params.per*86400.)**2)/(4.*(np.pi**2)))**(1./3))/r_star
                 if np.isnan(params.a) == True:
                     #For a: 25 for 10d; 17 for 8d; 10 for 4d; 4-8 (6) for 2 day; 2-5  for 1d; 1-3 (or 8?) for 0.5d
@@ -208,7 +262,8 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
             
                 elif injected_planet == 'exo_archive':
                     # Randomly inject planet from exoplanet archive
-                    exoplanet_data = Table.read("Exoplanet Archive Planets for injection.csv" , format='ascii.csv')
+                    # n.b. Read once per process rather than for every injection
+                    exoplanet_data = load_catalog(EXO_ARCHIVE_FILE, EXO_ARCHIVE_KEYS)['table']
                     pl_index = 760#random.randrange(1,1972,1)
                     params.per = exoplanet_data['pl_orbper'][pl_index]
                     params.rp = exoplanet_data['pl_radj'][pl_index]*r_Jup/(exoplanet_data['st_rad'][pl_index]*r_Sun)
@@ -218,6 +273,10 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
                     if not np.isnan(exoplanet_data['pl_orbeccen'][pl_index]):
                         params.ecc = exoplanet_data['pl_orbeccen'][pl_index]
                 
+                elif injected_planet == 'population':
+                    # Planet population_index of a batch from planet_population.sample_population
+                    params = population_params(injected_population, population_index)
+                
                 elif injected_planet == 'set_period':
                     params.per = 8.0
                     params.rp = random.uniform(0,0.2)
@@ -239,10 +298,9 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
                 index = int(len(lc_30min.time)//2)
                 mid_point = lc_30min.time[index]
                 t = lc_30min.time - lc_30min.time[index]
-                m = batman.TransitModel(params, t)
-                t += lc_30min.time[index]
         #        print("About to compute flux")
-                batman_flux = m.light_curve(params)
+                batman_flux = cached_light_curve(params, t)
+                t += lc_30min.time[index]
         #        print("Computed flux")
                 batman_model_fig = plt.figure()
                 plt.scatter(lc_30min.time, batman_flux, s = 2, c = 'k')
@@ -635,7 +693,6 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
         #    ########################## Periodogram Stuff ##################################
         
             # Create periodogram
-            durations = np.linspace(0.05, 1, 100) * u.day
             if use_TESSflatten == True:
                 BLS_flux = TESSflatten_flux
             elif detrending == 'lowess_full' or detrending == 'lowess_partial':
@@ -648,21 +705,57 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
     #            pickle.dump(t_cut, f, pickle.HIGHEST_PROTOCOL)
     #        with open('Detrended_flux.pkl', 'wb') as f:
     #            pickle.dump(BLS_flux, f, pickle.HIGHEST_PROTOCOL)
-            model = BoxLeastSquares(t_cut*u.day, BLS_flux)
+            # Search a binned copy of the residuals if requested; candidates are re-evaluated at full cadence below
+            if search_binning != False:
+                search_time, search_flux, search_err = bin_by_time(t_cut, BLS_flux, search_cad)
+            else:
+                search_time, search_flux, search_err = t_cut, BLS_flux, None
             #model = BLS(lc_30min.time*u.day,BLS_flux)
-            results = model.autopower(durations, minimum_n_transit=3,frequency_factor=1.0)
+            # Update and save the stored state whichever search is used, so the LS sums added above are kept
+            if use_state:
+                for sector_num, t_start, t_end in sector_edges:
+                    in_sector = (search_time >= t_start) & (search_time <= t_end)
+                    add_bls_sector(state, sector_num, search_time[in_sector], np.array(search_flux)[in_sector])
+                save_periodogram_state(state, state_filename)
+            if search_method == 'TLS':
+                # n.b. Imported here so transitleastsquares is only needed for TLS runs
+                from tls_search import tls_search
+                results, candidates, tls_results = tls_search(search_time, search_flux, durations, stellar_mass, stellar_radius, flux_err = search_err, rot_period = p_rot, n_threads = tls_threads, unit = u.day, n_transits_min = 3)
+            elif use_state:
+                results = bls_power_from_state(state, durations, stellar_mass, stellar_radius, unit = u.day)
+            else:
+                model = BoxLeastSquares(search_time*u.day, search_flux, search_err)
+                results = stellar_bls_autopower(model, durations, stellar_mass, stellar_radius, minimum_n_transit=3, frequency_factor=1.0)
             #results = model.autopower(durations, minimum_n_transit=2,frequency_factor=1.0)
             
+            # Find the strongest independent peaks, masking rotation harmonics and aliases
+            if search_method != 'TLS':
+                candidates = extract_candidates(results, n_candidates = 3, rot_period = p_rot)
+            if search_binning != False:
+                refine_candidates(BoxLeastSquares(t_cut*u.day, BLS_flux), results, candidates, durations)
+            if bootstrap_trials > 0:
+                # n.b. Every 5th trial duration is plenty for the significance and keeps the trials cheap
+                candidates = bootstrap_bls_fap(search_time, search_flux, candidates, results.period, durations[::5], n_trials = bootstrap_trials, flux_err = search_err, method = 'block', m_star = stellar_mass, r_star = stellar_radius)
+            print(candidates)
+            
             # Find the period and epoch of the peak
-            index = np.argmax(results.power)
+            index = candidates['index'][0]
             period = results.period[index]
             #print(results.period)
             t0 = results.transit_time[index]
             duration = results.duration[index]
-            transit_info = model.compute_stats(period, duration, t0)
-            print(transit_info)
             
-            epoch = transit_info['transit_times'][0]
+            # Vetting statistics and folded profiles for all candidates in one pass
+            vetting = vet_candidates(t_cut, BLS_flux, candidates)
+            vetting['depth','snr','odd_even_sigma','secondary_snr','n_transits'].pprint()
+            vetting.write(save_path + '{}_candidate_vetting.ecsv'.format(target_ID), overwrite = True)
+            
+            epoch = vetting['first_transit'][0]
+            
+            # Single transit-like events, which the BLS search cannot pick up
+            single_events = single_transit_search(t_cut, BLS_flux, durations[::5])
+            print(single_events)
+            single_events.write(save_path + '{}_single_events.csv'.format(target_ID), format = 'ascii.csv', overwrite = True)
             
         #    periodogram_fig, ax = plt.subplots(1, 1, figsize=(8, 4))
             periodogram_fig, ax = plt.subplots(1, 1)
@@ -697,54 +790,31 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
         	  
         
         ##    ################################## Phase folding ##########################
-            # Find indices of 2nd and 3rd peaks of periodogram
-            all_peaks = scipy.signal.find_peaks(results.power, width = 5, distance = 10)[0]
-#            print(all_peaks)
-            all_peak_powers = results.power[all_peaks]
-#            print(all_peak_powers)
-            sorted_power_indices = np.argsort(all_peak_powers)
-            sorted_peak_powers = all_peak_powers[sorted_power_indices]
-            sorted_peak_periods = results.period[all_peaks][sorted_power_indices]
-#            print(sorted_peak_periods)
-#            print('Started new section')
-            
-            # MASKS ALL HARMONICS OF MAXIMUM POWER PERIOD
-            # n.b. Uses a similar technique to masking bad times is tess_systematics cleaner:
-            # E.g. mask all those close to 1.5, 2, 2.5, 3, 3.5, 4, ..., 10 etc times the max period
-            # and then search through rest as normal
-            harmonic_mask = [False]*len(sorted_peak_powers)
-            harmonics = period.value*np.array([0.5,0.75,1,1.25,1.5,1.75,2,2.5,3,3.5,4,4.5,5,5.5,6,
-                                               6.5,7,7.5,8,8.5,9,9.5,10])
-            simplified_harmonics = period.value*np.array([0.333,0.5,0.75,1,1,1.5,2,3,4,5,6,7,8,9,10])
-#            print('Created Harmonics')
-            
-            for i in simplified_harmonics:
-                for j in range(len(sorted_peak_periods)):
-#                    print(sorted_peak_periods[j].value - i)
-                    if abs(sorted_peak_periods[j].value - i) < 0.1:
-                        harmonic_mask[j] = True
-#            print('Completed for loop')
-            harmonic_mask = np.array(harmonic_mask)
-            sorted_peak_powers = sorted_peak_powers[~harmonic_mask]
-            sorted_peak_periods = sorted_peak_periods[~harmonic_mask]
-#            print('Generated new cut-down peak powers')
-#            print(sorted_peak_powers)
-#            print(sorted_peak_periods)
-            
-            # Find info for 2nd largest peak in periodogram
-            index_peak_2 = np.where(results.power==sorted_peak_powers[-1])[0]
-            period_2 = results.period[index_peak_2[0]]
-            t0_2 = results.transit_time[index_peak_2[0]]
+            # Find info for 2nd and 3rd largest independent peaks in periodogram
+            # n.b. Short baselines or narrow period ranges can leave fewer than three peaks; missing ones are nan
+            if len(candidates['index']) > 1:
+                index_peak_2 = candidates['index'][1]
+                period_2 = results.period[index_peak_2]
+                t0_2 = results.transit_time[index_peak_2]
+            else:
+                period_2, t0_2 = np.nan*u.day, np.nan*u.day
             
-            # Find info for 3rd largest peak in periodogram
-            index_peak_3 = np.where(results.power==sorted_peak_powers[-2])[0]
-            period_3 = results.period[index_peak_3[0]]
-            t0_3 = results.transit_time[index_peak_3[0]]
+            if len(candidates['index']) > 2:
+                index_peak_3 = candidates['index'][2]
+                period_3 = results.period[index_peak_3]
+                t0_3 = results.transit_time[index_peak_3]
+            else:
+                period_3, t0_3 = np.nan*u.day, np.nan*u.day
             
             #phase_fold_plot(t_cut, BLS_flux, 8, mid_point+params.t0, target_ID, save_path, '{} with injected 8 day transit folded by transit period - {}R ratio'.format(target_ID, params.rp))
             #phase_fold_plot(lc_30min.time, BLS_flux, rot_period.value, rot_t0.value, target_ID, save_path, '{} folded by rotation period'.format(target_ID))
             #print('Max BLS Period = {} days, t0 = {}'.format(period.value, t0.value))        
-            phase_fold_plot(t_cut, BLS_flux, period.value, t0.value, target_ID, save_path, '{} {} residuals folded by Periodogram Max ({:.3f} days)'.format(target_ID, detrending, period.value))
+            # Candidate folds come straight from the vetting profiles rather than re-folding the lc
+            profile_plot(vetting, 0, target_ID, save_path, '{} {} residuals folded by Periodogram Max ({:.3f} days)'.format(target_ID, detrending, period.value))
+            profiles = Table({'phase':vetting.meta['profile_phase']})
+            for k in range(len(vetting)):
+                profiles['profile_{}'.format(k+1)] = vetting['profile'][k]
+            profiles.write(save_path + '{}_candidate_profiles.csv'.format(target_ID), format = 'ascii.csv', overwrite = True)
             period_to_test = p_rot
             t0_to_test = 1332
             period_to_test2 = period_2.value
@@ -754,8 +824,8 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
             period_to_test4 = 5.47
             t0_to_test4 = 1489.41     
             phase_fold_plot(t_cut, BLS_flux, p_rot, t0_to_test, target_ID, save_path, '{} folded by rotation period ({} days)'.format(target_ID,period_to_test))
-            phase_fold_plot(t_cut, BLS_flux, period_to_test2, t0_to_test2, target_ID, save_path, '{} detrended lc folded by 2nd largest peak ({:0.4} days)'.format(target_ID,period_to_test2))
-            phase_fold_plot(t_cut, BLS_flux, period_to_test3, t0_to_test3, target_ID, save_path, '{} detrended lc folded by 3rd largest peak ({:0.4} days)'.format(target_ID,period_to_test3))
+            profile_plot(vetting, 1, target_ID, save_path, '{} detrended lc folded by 2nd largest peak ({:0.4} days)'.format(target_ID,period_to_test2))
+            profile_plot(vetting, 2, target_ID, save_path, '{} detrended lc folded by 3rd largest peak ({:0.4} days)'.format(target_ID,period_to_test3))
             phase_fold_plot(t_cut, BLS_flux, period_to_test4, t0_to_test4, target_ID, save_path, '{} detrended lc folded by {:0.4} days'.format(target_ID,period_to_test4))
             #print("Absolute amplitude of main variability = {}".format(amplitude_peaks))
             #print('Main Variability Period from Lomb-Scargle = {:.3f}d'.format(p_rot))
@@ -805,8 +875,9 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
             #epoch = t0_3.value 
 #            period = 6.96
 #            print('Main epoch is {}'.format(t0.value+lc_30min.time[0]))
+            # n.b. Per-point phases are only kept for the return value; the plots use the binned vetting profile
             phase = np.mod(t_cut-epoch-period/2,period)/period 
-            axs[1,1].scatter(phase, BLS_flux, c='k', s=1)
+            axs[1,1].scatter(vetting.meta['profile_phase'], vetting['profile'][0], c='k', s=4)
             axs[1,1].set_title('{} Lightcurve folded by {:0.4} days'.format(target_ID, period))
             axs[1,1].set_xlabel('Phase')
             axs[1,1].set_ylabel('Normalized Flux')
@@ -851,7 +922,7 @@ def ffi_lowess_detrend(save_path = '/Users/mbattley/Documents/PhD/New detrending
                 ax2.axvline(n*period, alpha=0.4, lw=1, linestyle="dashed")
                 ax2.axvline(period / n, alpha=0.4, lw=1, linestyle="dashed")
             
-            ax3.scatter(phase, BLS_flux, c='k', s=1)
+            ax3.scatter(vetting.meta['profile_phase'], vetting['profile'][0], c='k', s=4)
             ax3.set_xlabel('Phase')
             ax3.set_ylabel('Normalized Flux')
             ax3.set_xlim(0,1)
@@ -895,6 +966,22 @@ def phase_fold_plot(t, lc, period, epoch, target_ID, save_path, title, binned =
     plt.show()
 #    plt.close(phase_fold_fig)
  
+def profile_plot(vetting, k, target_ID, save_path, title):
+    """
+    Plots the binned phase-folded profile of candidate k from vet_candidates
+    (transit at phase 0.5)
+    """
+    if k >= len(vetting):
+        return
+    period = vetting['period'][k]
+    period = getattr(period, 'value', period)
+    profile_fig = plt.figure()
+    plt.scatter(vetting.meta['profile_phase'], vetting['profile'][k], c='k', s=4)
+    plt.title(title)
+    plt.xlabel('Phase')
+    plt.ylabel('Normalized Flux')
+    plt.savefig(save_path + '{} - Phase folded by {} days.png'.format(target_ID, float(period)))
+    plt.show()
  
 def bin(time, flux, binsize=15, method='mean'):
     """Bins a lightcurve in blocks of size `binsize`.
@@ -23,6 +23,9 @@ from lc_download_methods import *
 from statsmodels.nonparametric.kernel_regression import KernelReg
 from scipy.signal import find_peaks
 from wotan import flatten
+from transit_search import stellar_bls_autopower
+from utility_belt import stellar_mass_radius
+from transit_templates import cached_light_curve
 
 def phase_fold_plot(t, lc, period, epoch, target_ID, save_path, title):
     """
@@ -90,6 +93,9 @@ for target_ID in all_target_IDs:
     #    plt.close(sigma_cut_lc_fig)
         
     
+        # Stellar mass and radius used to bound the BLS trial durations
+        stellar_mass, stellar_radius = stellar_mass_radius(target_ID)
+        
         ########################### batman stuff ######################################
         type_of_planet = 'Hot Jupiter'
         stellar_type = 'F or G'
@@ -116,11 +122,9 @@ for target_ID in all_target_IDs:
         index = int(len(lc_30min.time)//2)
         mid_point = lc_30min.time[index]
         t = lc_30min.time - lc_30min.time[index]
-        m = batman.TransitModel(params, t)
+        batman_flux = cached_light_curve(params, t)
         t += lc_30min.time[index]
         
-        batman_flux = m.light_curve(params)
-        
     #    batman_model_fig = plt.figure()
     #    plt.scatter(lc_30min.time, batman_flux, s = 2, c = 'k')
     #    plt.xlabel("Time - 2457000 (BTJD days)")
@@ -590,7 +594,7 @@ for target_ID in all_target_IDs:
             durations = np.linspace(0.05, 0.2, 22) * u.day
         #    model = BLS(lc_30min.time*u.day, combined_flux)
             model = BLS(lc_30min.time*u.day, residuals)
-            results = model.autopower(durations, frequency_factor=5.0)
+            results = stellar_bls_autopower(model, durations, stellar_mass, stellar_radius, minimum_n_transit=3, frequency_factor=5.0)
             
             # Find the period and epoch of the peak
             index = np.argmax(results.power)
@@ -669,7 +673,7 @@ for target_ID in all_target_IDs:
             BLS_flux = residual_flux
         model = BLS(t_cut*u.day, BLS_flux)
     #    model = BLS(lc_30min.time*u.day, BLS_flux)
-        results = model.autopower(durations, frequency_factor=5.0)
+        results = stellar_bls_autopower(model, durations, stellar_mass, stellar_radius, minimum_n_transit=3, frequency_factor=5.0)
         
         # Find the period and epoch of the peak
         index = np.argmax(results.power)
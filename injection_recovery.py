@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:08:36 2026
+injection_recovery.py
+
+Parallel, checkpointed injection-recovery grids for sensitivity analysis.
+
+A (target x period x radius x phase) grid is expanded into independent tasks,
+which are run in a process pool. Each star's cleaned lc, stellar parameters
+and rotation period are prepared once and handed to every worker when the
+pool starts, so a task only costs the injection, detrending and BLS search.
+Finished tasks are written in small parts (FITS binary tables) to an output
+directory as they come in; re-running with the same directory skips every
+task already stored, so an interrupted grid picks up where it stopped.
+
+@author: mbattley
+"""
+
+import os
+import glob
+import zlib
+import numpy as np
+import batman
+import astropy.units as u
+import multiprocessing as multip
+from astropy.table import Table, vstack
+from astropy.timeseries import BoxLeastSquares, LombScargle
+from lowess_detrend import lowess_detrending, lowess_baseline, localized_lowess_detrend
+from transit_search import stellar_bls_autopower, extract_candidates, scaled_semi_major_axis
+from transit_templates import cached_light_curve
+from recovery_classifier import classify_recoveries
+
+def injection_grid(target_IDs, periods, radii, n_phases = 1, seed = 42):
+    """
+    Expands the grid into a table of tasks, one per (target, period, radius,
+    phase). Epochs are drawn uniformly in phase (t0_phase, as a fraction of
+    the period after the start of the lc) from a seeded generator.
+    n.b. radii are planet to star radius ratios, as for injected_rp
+    """
+    target_grid, period_grid, rp_grid, _ = np.meshgrid(np.asarray(target_IDs), np.asarray(periods, dtype=float),
+                                                       np.asarray(radii, dtype=float), np.arange(n_phases), indexing='ij')
+    rng = np.random.default_rng(seed)
+    tasks = Table()
+    tasks['task_id'] = np.arange(target_grid.size)
+    tasks['target_ID'] = target_grid.ravel()
+    tasks['period'] = period_grid.ravel()
+    tasks['rp'] = rp_grid.ravel()
+    tasks['t0_phase'] = rng.random(target_grid.size)
+    return tasks
+
+def prepare_star(time, flux, m_star = np.nan, r_star = np.nan):
+    """
+    Normalised lc and stellar information shared by all injections into one
+    star, including the LS rotation period used to mask rotation harmonics.
+    The baseline lowess trends used for localized re-detrending are added to
+    it (under 'baselines') the first time they are needed.
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(time) & np.isfinite(flux)
+    time = time[good]
+    flux = flux[good]/np.median(flux[good])
+    freq = np.arange(0.04,4.1,0.00001)
+    power = LombScargle(time, flux).power(freq)
+    return {'time':time, 'flux':flux, 'm_star':m_star, 'r_star':r_star, 'rot_period':1/freq[np.argmax(power)]}
+
+def injection_params(period, rp, t0, m_star, r_star):
+    """
+    batman parameters for an injected planet, as set up in ffi_lowess_detrend
+    n.b. m_star and r_star in solar units; a = 17 stellar radii if unknown
+    """
+    params = batman.TransitParams()
+    params.t0 = t0
+    params.per = period
+    params.rp = rp
+    params.a = float(scaled_semi_major_axis(period, m_star, r_star))
+    if np.isnan(params.a) == True:
+        params.a = 17.
+    params.inc = 90.
+    params.ecc = 0.
+    params.w = 90.
+    params.limb_dark = "nonlinear"
+    params.u = [0.5, 0.1, 0.1, -0.1]
+    return params
+
+def run_injection(star, target_ID, period, rp, t0_phase, detrending = 'lowess_partial', n_bins = 30, pipeline = '2min', durations = None, localized = True, exact_detrend = False):
+    """
+    Injects one planet into a prepared star, detrends and searches it, and
+    returns the result as a dict (one row of the results table)
+    n.b. localized = True refits the trend only around the injected transits,
+         reusing the star's cached baseline trend everywhere else;
+         exact_detrend = True refits whole sections instead, as a check (see
+         localized_lowess_detrend)
+    """
+    if durations is None:
+        durations = np.linspace(0.05, 1, 100)*u.day
+    t0 = star['time'][0] + t0_phase*period
+    params = injection_params(period, rp, t0, star['m_star'], star['r_star'])
+    batman_flux = cached_light_curve(params, star['time'])
+    combined_flux = star['flux'] + batman_flux - 1
+    if localized == True:
+        baselines = star.setdefault('baselines', {})
+        key = (detrending, n_bins, pipeline)
+        if key not in baselines:
+            baselines[key] = lowess_baseline(star['time'], star['flux'], detrending, n_bins, pipeline)
+        residual_flux, _, t_kept = localized_lowess_detrend(baselines[key], combined_flux, batman_flux != 1., exact_detrend)
+    else:
+        residual_flux, _, t_kept = lowess_detrending(star['time'], combined_flux, target_ID, pipeline, detrending, n_bins, plot_figs = False, return_time = True)
+    model = BoxLeastSquares(t_kept*u.day, residual_flux)
+    results = stellar_bls_autopower(model, durations, star['m_star'], star['r_star'], minimum_n_transit=3, frequency_factor=1.0)
+    candidates = extract_candidates(results, n_candidates = 3, rot_period = star['rot_period'])
+    found = list(candidates['period'].value if hasattr(candidates['period'], 'value') else candidates['period'])
+    found += [np.nan]*(3 - len(found))
+    max_power = candidates['power'][0] if len(candidates) > 0 else np.nan
+    return {'target_ID':target_ID, 'period':period, 'rp':rp, 't0':t0, 'a':params.a,
+            'max_period':found[0], 'period_2':found[1], 'period_3':found[2], 'max_power':max_power,
+            'recovered':bool(classify_recoveries([period], [found])[0]), 'failed':False, 'error':''}
+
+_stars = {}
+
+def _init_worker(stars):
+    global _stars
+    _stars = stars
+
+# n.b. Errors a single injection can legitimately hit while detrending/fitting
+#      (e.g. too few points left in a section); anything else is a bug and is raised
+FIT_ERRORS = (ValueError, ArithmeticError)
+
+def _run_job(job):
+    """
+    Runs a block of tasks for one star. Tasks whose fit fails are recorded
+    as failed (with the error) and are retried on the next resume
+    """
+    target_ID, tasks, settings = job
+    rows = []
+    for task in tasks:
+        try:
+            row = run_injection(_stars[target_ID], target_ID, task['period'], task['rp'], task['t0_phase'], **settings)
+        except FIT_ERRORS as exc:
+            row = {'target_ID':target_ID, 'period':task['period'], 'rp':task['rp'], 't0':np.nan, 'a':np.nan,
+                   'max_period':np.nan, 'period_2':np.nan, 'period_3':np.nan, 'max_power':np.nan,
+                   'recovered':False, 'failed':True, 'error':repr(exc)}
+        row['task_id'] = task['task_id']
+        row['t0_phase'] = task['t0_phase']
+        rows.append(row)
+    return rows
+
+def load_injection_results(output_dir):
+    """
+    All results stored so far in output_dir as a single table (None if empty)
+    n.b. Failed attempts at a task that has since succeeded are left out
+    """
+    parts = sorted(glob.glob(os.path.join(output_dir, 'part_*.fits')))
+    if len(parts) == 0:
+        return None
+    results = vstack([Table.read(part) for part in parts])
+    failed = np.asarray(results['failed'], dtype=bool)
+    superseded = failed & np.isin(results['task_id'], results['task_id'][~failed])
+    return results[~superseded]
+
+def run_injection_grid(tasks, stars, output_dir, n_workers = None, checkpoint_every = 20, **settings):
+    """
+    Runs every task in 'tasks' (from injection_grid) not already stored in
+    output_dir, using stars (dict of target_ID -> prepare_star output)
+
+    Tasks are sent to the pool in blocks of checkpoint_every per star and each
+    finished block is saved straight away as a new part file. Any extra
+    keyword arguments (detrending, n_bins, pipeline, durations, localized, exact_detrend) are passed on
+    to run_injection. Returns the full table of stored results.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    done = load_injection_results(output_dir)
+    if done is not None:
+        succeeded = ~np.asarray(done['failed'], dtype=bool)
+        tasks = tasks[~np.isin(tasks['task_id'], done['task_id'][succeeded])]
+    n_parts = len(glob.glob(os.path.join(output_dir, 'part_*.fits')))
+
+    jobs = []
+    for target_ID in np.unique(tasks['target_ID']):
+        star_tasks = [dict(zip(tasks.colnames, row)) for row in tasks[tasks['target_ID'] == target_ID]]
+        for start in range(0, len(star_tasks), checkpoint_every):
+            jobs.append((target_ID, star_tasks[start:start+checkpoint_every], settings))
+    if len(jobs) == 0:
+        return done
+
+    if n_workers is None:
+        n_workers = multip.cpu_count()
+    if n_workers > 1:
+        pool = multip.Pool(n_workers, initializer = _init_worker, initargs = (stars,))
+        finished = pool.imap_unordered(_run_job, jobs)
+    else:
+        _init_worker(stars)
+        finished = map(_run_job, jobs)
+
+    for rows in finished:
+        filename = os.path.join(output_dir, 'part_{:06d}.fits'.format(n_parts))
+        Table(rows = rows).write(filename + '.tmp', format = 'fits', overwrite = True)
+        # n.b. Renaming means a crash mid-write never leaves a partial part behind
+        os.replace(filename + '.tmp', filename)
+        n_parts += 1
+        print('Saved {} injections to {}'.format(len(rows), filename))
+
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+    return load_injection_results(output_dir)
+
+######################## Adaptive sensitivity sampling ########################
+
+def completeness_error(n_recovered, n_injected):
+    """
+    Standard deviation of the recovered fraction, from its Beta posterior
+    (uniform prior), which stays sensible for 0 or all recovered
+    """
+    a = np.asarray(n_recovered, dtype=float) + 1
+    b = np.asarray(n_injected, dtype=float) - n_recovered + 1
+    return np.sqrt(a*b/((a + b)**2*(a + b + 1)))
+
+def _bisect_period(job):
+    """
+    Bisects in log(rp) at one period towards 50% recovery; see
+    adaptive_sensitivity
+    """
+    target_ID, period, rp_min, rp_max, n_phases, precision, max_steps, seed, settings = job
+    star = _stars[target_ID]
+    # n.b. One generator per (star, period) so the phases do not depend on how periods are shared between workers
+    # n.b. crc32 of the ID rather than hash(), which is salted per process
+    rng = np.random.default_rng([seed, zlib.crc32(str(target_ID).encode()), int(round(period*1e6))])
+    rows = []
+
+    def trial(rp):
+        recovered = [run_injection(star, target_ID, period, rp, phase, **settings)['recovered'] for phase in rng.random(n_phases)]
+        n_recovered = int(np.sum(recovered))
+        rows.append((target_ID, period, rp, n_phases, n_recovered, n_recovered/n_phases))
+        return n_recovered/n_phases >= 0.5
+
+    lo, hi = rp_min, rp_max
+    # Check the bracket first: the threshold may lie outside the range searched
+    if trial(hi) == False:
+        lo = hi = np.nan
+    elif trial(lo) == True:
+        lo = hi = np.nan
+    else:
+        for step in range(max_steps):
+            if hi/lo - 1 <= precision:
+                break
+            mid = np.sqrt(lo*hi)
+            if trial(mid) == True:
+                hi = mid
+            else:
+                lo = mid
+    return rows, (target_ID, period, lo, hi)
+
+def adaptive_sensitivity(stars, target_IDs, periods, rp_min = 0.01, rp_max = 0.2, n_phases = 10, precision = 0.05, max_steps = 10, seed = 42, n_workers = None, **settings):
+    """
+    Adaptive alternative to a fixed period x radius injection grid
+
+    For each star and period, rp (planet to star radius ratio) is bisected in
+    log space towards the value where half of n_phases injections at random
+    epochs are recovered, stopping once the bracket is narrower than
+    'precision' (fractional) or after max_steps steps. Extra keyword arguments
+    go to run_injection. Periods are shared between n_workers processes.
+
+    Returns (completeness, thresholds): completeness has one row per trial
+    radius with the number injected and recovered, the recovered fraction and
+    its error; thresholds has the 50% radius (geometric centre of the final
+    bracket) and its error (half the bracket) for each star and period, nan
+    if it lies outside rp_min to rp_max.
+    n.b. Transit depth is about rp**2, so this also pins the threshold depth
+    """
+    jobs = [(target_ID, float(period), rp_min, rp_max, n_phases, precision, max_steps, seed, settings)
+            for target_ID in target_IDs for period in periods]
+    if n_workers is None:
+        n_workers = multip.cpu_count()
+    if n_workers > 1:
+        pool = multip.Pool(n_workers, initializer = _init_worker, initargs = (stars,))
+        finished = pool.map(_bisect_period, jobs)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(stars)
+        finished = list(map(_bisect_period, jobs))
+
+    completeness = Table(rows = [row for rows, _ in finished for row in rows],
+                         names = ['target_ID','period','rp','n_injected','n_recovered','completeness'])
+    completeness['completeness_err'] = completeness_error(completeness['n_recovered'], completeness['n_injected'])
+    completeness.sort(['target_ID','period','rp'])
+    thresholds = Table(rows = [bracket for _, bracket in finished], names = ['target_ID','period','rp_lower','rp_upper'])
+    thresholds['rp_50'] = np.sqrt(thresholds['rp_lower']*thresholds['rp_upper'])
+    thresholds['rp_50_err'] = 0.5*(thresholds['rp_upper'] - thresholds['rp_lower'])
+    return completeness, thresholds
@@ -18,7 +18,9 @@ import matplotlib.pyplot as plt
 
 ############################## LOWESS detrending ##############################
 
-def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='lowess_partial',n_bins=30,save_path=''):
+def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='lowess_partial',n_bins=30,save_path='',plot_figs=True,return_time=False):
+    # n.b. plot_figs = False skips all figures (e.g. for injection grids)
+    #      return_time = True also returns the times kept, as partial detrending skips sections too short to fit
 
     # Full lc
     if detrending == 'lowess_full':
@@ -27,31 +29,34 @@ def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='l
         
     #     number of points = 20 at lowest, or otherwise frac = 20/len(t_section) 
 #        print(lowess)
-        overplotted_lowess_full_fig = plt.figure()
-        plt.scatter(time,flux, c = 'k', s = 1)
-        plt.plot(lowess[:, 0], lowess[:, 1])
-        plt.title('{} lc with overplotted lowess full lc detrending'.format(target_ID))
-        plt.xlabel('Time [BJD days]')
-        plt.ylabel('Relative flux')
-        #overplotted_lowess_full_fig.savefig(save_path + "{} lc with overplotted LOWESS full lc detrending.png".format(target_ID))
-        plt.show()
+        if plot_figs == True:
+            overplotted_lowess_full_fig = plt.figure()
+            plt.scatter(time,flux, c = 'k', s = 1)
+            plt.plot(lowess[:, 0], lowess[:, 1])
+            plt.title('{} lc with overplotted lowess full lc detrending'.format(target_ID))
+            plt.xlabel('Time [BJD days]')
+            plt.ylabel('Relative flux')
+            #overplotted_lowess_full_fig.savefig(save_path + "{} lc with overplotted LOWESS full lc detrending.png".format(target_ID))
+            plt.show()
     #   plt.close(overplotted_lowess_full_fig)
         
         residual_flux_lowess = flux/lowess[:,1]
         full_lowess_flux = np.concatenate((full_lowess_flux,lowess[:,1]))
+        time_from_lowess_detrend = time
         
-        lowess_full_residuals_fig = plt.figure()
-        plt.scatter(time,residual_flux_lowess, c = 'k', s = 1)
-        plt.title('{} lc after lowess full lc detrending'.format(target_ID))
-        plt.xlabel('Time [BJD days]')
-        plt.ylabel('Relative flux')
-        ax = plt.gca()
-        #ax.axvline(params.t0+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0+params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0+2*params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0-params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-    #            lowess_full_residuals_fig.savefig(save_path + "{} lc after LOWESS full lc detrending.png".format(target_ID))
-        plt.show()
+        if plot_figs == True:
+            lowess_full_residuals_fig = plt.figure()
+            plt.scatter(time,residual_flux_lowess, c = 'k', s = 1)
+            plt.title('{} lc after lowess full lc detrending'.format(target_ID))
+            plt.xlabel('Time [BJD days]')
+            plt.ylabel('Relative flux')
+            ax = plt.gca()
+            #ax.axvline(params.t0+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0+params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0+2*params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0-params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+        #            lowess_full_residuals_fig.savefig(save_path + "{} lc after LOWESS full lc detrending.png".format(target_ID))
+            plt.show()
     #                plt.close(lowess_full_residuals_fig)
         
         
@@ -63,10 +68,11 @@ def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='l
         time_from_lowess_detrend = np.array([])
         full_lowess_flux = np.array([])
         
-        overplotted_detrending_fig = plt.figure()
-        plt.scatter(time,flux, c = 'k', s = 2)
-        plt.xlabel('Time [BJD days]')
-        plt.ylabel("Normalized flux")
+        if plot_figs == True:
+            overplotted_detrending_fig = plt.figure()
+            plt.scatter(time,flux, c = 'k', s = 2)
+            plt.xlabel('Time [BJD days]')
+            plt.ylabel("Normalized flux")
         #plt.title('{} lc with overplotted detrending'.format(target_ID))
         
         low_bound = 0
@@ -85,7 +91,8 @@ def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='l
                     lowess = sm.nonparametric.lowess(flux_section, t_section, frac=n_bins/len(t_section))
     #                    lowess = sm.nonparametric.lowess(flux_section, t_section, frac=20/len(t_section))
                     lowess_flux_section = lowess[:,1]
-                    plt.plot(t_section, lowess_flux_section, '-')
+                    if plot_figs == True:
+                        plt.plot(t_section, lowess_flux_section, '-')
                     
                     residuals_section = flux_section/lowess_flux_section
                     residual_flux_lowess = np.concatenate((residual_flux_lowess,residuals_section))
@@ -107,10 +114,11 @@ def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='l
         lowess = sm.nonparametric.lowess(flux_section, t_section, frac=n_bins/len(t_section))
     #            lowess = sm.nonparametric.lowess(flux_section, t_section, frac=20/len(t_section))
         lowess_flux_section = lowess[:,1]
-        plt.plot(t_section, lowess_flux_section, '-')
+        if plot_figs == True:
+            plt.plot(t_section, lowess_flux_section, '-')
     #                plt.title('AU Mic - Overplotted LOWESS detrending')
-        overplotted_detrending_fig.savefig(save_path + "{} - Overplotted lowess detrending - partial lc".format(target_ID))
-        overplotted_detrending_fig.show()
+            overplotted_detrending_fig.savefig(save_path + "{} - Overplotted lowess detrending - partial lc".format(target_ID))
+            overplotted_detrending_fig.show()
     #                plt.close(overplotted_detrending_fig)
         
         residuals_section = flux_section/lowess_flux_section
@@ -125,18 +133,111 @@ def lowess_detrending(time=[],flux=[],target_ID='',pipeline='2min',detrending='l
             full_lowess_flux = np.concatenate((full_lowess_flux,lowess_flux_section))
         
     #    t_section = t_cut[83:133]
-        residuals_after_lowess_fig = plt.figure()
-        plt.scatter(time_from_lowess_detrend,residual_flux_lowess, c = 'k', s = 2)
-        plt.title('{} lc after LOWESS partial lc detrending'.format(target_ID))
-        plt.xlabel('Time - 2457000 [BTJD days]')
-        plt.ylabel('Relative flux')
-        #ax = plt.gca()
-        #ax.axvline(params.t0+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0+params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0+2*params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        #ax.axvline(params.t0-params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
-        residuals_after_lowess_fig.savefig(save_path + "{} lc after LOWESS partial lc detrending".format(target_ID))
-        residuals_after_lowess_fig.show()
+        if plot_figs == True:
+            residuals_after_lowess_fig = plt.figure()
+            plt.scatter(time_from_lowess_detrend,residual_flux_lowess, c = 'k', s = 2)
+            plt.title('{} lc after LOWESS partial lc detrending'.format(target_ID))
+            plt.xlabel('Time - 2457000 [BTJD days]')
+            plt.ylabel('Relative flux')
+            #ax = plt.gca()
+            #ax.axvline(params.t0+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0+params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0+2*params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            #ax.axvline(params.t0-params.per+lc_30min.time[index], ymin = 0.1, ymax = 0.2, lw=1, c = 'r')
+            residuals_after_lowess_fig.savefig(save_path + "{} lc after LOWESS partial lc detrending".format(target_ID))
+            residuals_after_lowess_fig.show()
     #                plt.close(residuals_after_lowess_fig)
     
-    return residual_flux_lowess, full_lowess_flux
\ No newline at end of file
+    if return_time == True:
+        return residual_flux_lowess, full_lowess_flux, time_from_lowess_detrend
+    return residual_flux_lowess, full_lowess_flux
+###################### Localized lowess re-detrending #########################
+
+def lowess_sections(time, detrending='lowess_partial', n_bins=30, pipeline='2min'):
+    """
+    The sections fitted separately by lowess_detrending, as a list of
+    (start, end, keep, k): time[start:end] is fitted with k points in each
+    local fit and its trend is kept from start+keep on
+    """
+    n = len(time)
+    if detrending == 'lowess_full':
+        return [(0, n, 0, int(0.02*n + 1e-10))]
+    if pipeline == '2min':
+        n_bins = 15*n_bins
+    sections = []
+    time_diff = np.diff(time)
+    low_bound = 0
+    for i in range(n-1):
+        if time_diff[i] > 0.1 and i+1 - low_bound >= n_bins:
+            sections.append((low_bound, i+1, 0, n_bins))
+            low_bound = i+1
+    # n.b. Same treatment of the final section as lowess_detrending: stretched back to n_bins points
+    keep = 0
+    if n - low_bound < n_bins:
+        keep = n_bins - (n - low_bound)
+        low_bound = n - n_bins
+    sections.append((low_bound, n, keep, n_bins))
+    return sections
+
+def lowess_baseline(time, flux, detrending='lowess_partial', n_bins=30, pipeline='2min', it=3):
+    """
+    Lowess trend of the uninjected lc, section by section as in
+    lowess_detrending, cached for localized_lowess_detrend
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    sections = lowess_sections(time, detrending, n_bins, pipeline)
+    trend = np.full(len(time), np.nan)
+    for start, end, keep, k in sections:
+        lowess_flux = sm.nonparametric.lowess(flux[start:end], time[start:end], frac=k/(end-start), it=it, return_sorted=False)
+        trend[start+keep:end] = lowess_flux[keep:]
+    return {'time':time, 'flux':flux, 'trend':trend, 'sections':sections, 'it':it}
+
+def localized_lowess_detrend(baseline, flux, changed, exact=False):
+    """
+    Lowess detrending of 'flux' (the baseline lc plus e.g. an injected
+    transit, on the same times) which only refits the trend around the points
+    flagged in 'changed' and reuses the cached baseline trend elsewhere.
+    Returns (residual_flux, lowess_flux, time) as lowess_detrending does
+    with return_time = True.
+
+    Each local fit uses the k nearest points, so the trend only moves directly
+    within k points of a changed run. By default just these windows are
+    refitted, from a stretch of data wide enough again that their
+    neighbourhoods are complete, which is exact for it = 0.
+    n.b. With it > 0 the robustifying iterations let a change leak a little
+         further (up to (it+1)*k, plus the section-wide residual scale). The
+         leak is far below the noise (<5% of it for a 2min lc) but not zero,
+         so exact = True refits every section containing a change in full,
+         identical to a full re-detrend and no faster, as a check.
+         Injections whose transits are less than ~2k points apart also end up
+         refitting whole sections.
+    """
+    time = baseline['time']
+    flux = np.asarray(flux, dtype=float)
+    changed = np.asarray(changed, dtype=bool)
+    trend = baseline['trend'].copy()
+    it = baseline['it']
+    for start, end, keep, k in baseline['sections']:
+        idx = np.where(changed[start:end])[0]
+        if len(idx) == 0:
+            continue
+        n = end - start
+        if exact == True and it > 0:
+            windows = [(0, n)]
+            reach = 0
+        else:
+            # Merge the affected windows of nearby changed runs
+            reach = k
+            run_starts = idx[np.concatenate(([True], np.diff(idx) > 2*reach))]
+            run_ends = idx[np.concatenate((np.diff(idx) > 2*reach, [True]))] + 1
+            windows = zip(np.maximum(run_starts - reach, 0), np.minimum(run_ends + reach, n))
+        for lo, hi in windows:
+            sub_lo = max(lo - reach, 0)
+            sub_hi = min(hi + reach, n)
+            lowess_flux = sm.nonparametric.lowess(flux[start+sub_lo:start+sub_hi], time[start+sub_lo:start+sub_hi],
+                                                  frac=k/(sub_hi-sub_lo), it=it, return_sorted=False)
+            lo = max(lo, keep)
+            trend[start+lo:start+hi] = lowess_flux[lo-sub_lo:hi-sub_lo]
+    kept = np.isfinite(trend)
+    return flux[kept]/trend[kept], trend[kept], time[kept]
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:03:27 2026
+periodogram_state.py
+
+Additive periodogram accumulators for multi-sector searches.
+
+Both Lomb-Scargle and BLS only depend on sums over the data points: trig sums
+for LS and phase-binned weight/flux sums for BLS. Kept on a fixed global
+frequency/period grid these can simply be added sector by sector, so adding a
+new sector for a star only costs the new sector rather than recomputing both
+periodograms over the whole stitched lc. The running totals are pickled per
+target along with the list of sectors they already contain.
+
+@author: mbattley
+"""
+
+import os
+import pickle
+import numpy as np
+from astropy.timeseries import BoxLeastSquaresResults
+from astropy.timeseries.periodograms.lombscargle.implementations.utils import trig_sum
+from transit_search import transit_duration_bounds
+
+def default_frequency_grid():
+    """
+    Same LS grid as used for rotation periods in ffi_lowess_detrend
+    """
+    return np.arange(0.04,4.1,0.00001)
+
+def default_period_grid(min_period = 0.5, max_period = 15., n_periods = 50000, baseline = None, min_duration = 0.05, oversample = 3):
+    """
+    Fixed BLS period grid, evenly spaced in frequency. If the baseline (days)
+    the state has to cover is given, the frequency step keeps the transit
+    drift across it below min_duration/oversample at max_period (as in
+    joint_period_grid), otherwise n_periods periods are used.
+    n.b. The grid grows with the baseline: ~1e6 periods for sectors 2 years apart
+    """
+    if baseline is not None:
+        df = min_duration/(oversample*baseline*max_period)
+        return np.sort(1/np.arange(1/max_period, 1/min_period + df, df))
+    return np.sort(1/np.linspace(1/max_period, 1/min_period, n_periods))
+
+def resolvable_baseline(periods, min_duration = 0.05):
+    """
+    Longest baseline (days) over which a transit drifts by less than
+    min_duration between neighbouring trial periods of the grid
+    """
+    freq = np.sort(1/np.asarray(periods, dtype=float))
+    return min_duration/(np.max(np.diff(freq))*np.max(periods))
+
+def new_periodogram_state(freq = None, periods = None, n_bins = 200, t_ref = 1325., baseline = None, min_duration = 0.05, settings = None):
+    """
+    Sets up an empty state on the given global grids. t_ref is the common
+    reference time for BLS phases (BTJD); baseline is the time span (days)
+    the BLS period grid must be able to resolve (see default_period_grid);
+    settings records how the lc was prepared (e.g. pipeline and detrending),
+    since only sums of identically prepared sectors can be added
+    """
+    if freq is None:
+        freq = default_frequency_grid()
+    if periods is None:
+        periods = default_period_grid(baseline = baseline, min_duration = min_duration)
+    state = {'freq':np.asarray(freq, dtype=float), 'periods':np.asarray(periods, dtype=float),
+             'n_bins':int(n_bins), 't_ref':float(t_ref), 'flux_offset':1., 'min_duration':float(min_duration),
+             't_span':[np.inf, -np.inf], 'ls_sectors':[], 'bls_sectors':[], 'ls':None, 'bls':None,
+             'settings':settings}
+    return state
+
+def load_periodogram_state(filename, settings = None, **grid_kwargs):
+    """
+    Loads a pickled state, or starts a new one if the file does not exist yet.
+    Raises a ValueError if the stored state was built with other settings.
+    """
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('settings') != settings:
+            raise ValueError('{} was built with settings {}, not {}'.format(filename, state.get('settings'), settings))
+        return state
+    return new_periodogram_state(settings = settings, **grid_kwargs)
+
+def save_periodogram_state(state, filename):
+    with open(filename, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+def _weights(time, flux_err):
+    if flux_err is None:
+        return np.ones(len(time))
+    return 1/np.asarray(flux_err, dtype=float)**2
+
+def ls_accumulators(time, flux, freq, flux_err = None):
+    """
+    All the (unnormalised) weighted sums needed for a floating-mean LS
+    periodogram on the regular grid freq
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    w = _weights(time, flux_err)
+    df = freq[1] - freq[0]
+    S, C = trig_sum(time, w, df, len(freq), f0=freq[0])
+    S2, C2 = trig_sum(time, w, df, len(freq), f0=freq[0], freq_factor=2)
+    Ys, Yc = trig_sum(time, w*flux, df, len(freq), f0=freq[0])
+    return {'W':np.sum(w), 'Y':np.sum(w*flux), 'YY':np.sum(w*flux**2),
+            'S':S, 'C':C, 'S2':S2, 'C2':C2, 'Ys':Ys, 'Yc':Yc}
+
+def phase_bin_indices(time, periods, n_bins, t_ref):
+    """
+    Flattened (period, phase bin) index of every data point at each period,
+    for use with binned_sums
+    """
+    phase = np.mod((time[None,:] - t_ref)/periods[:,None], 1.)
+    bins = np.minimum((phase*n_bins).astype(int), n_bins-1)
+    return (bins + n_bins*np.arange(len(periods))[:,None]).ravel()
+
+def binned_sums(flat, values, n_periods, n_bins):
+    """
+    Sums values into the (period, phase bin) cells given by phase_bin_indices
+    """
+    return np.bincount(flat, weights=np.tile(values, n_periods), minlength=n_periods*n_bins).reshape(n_periods, n_bins)
+
+def bls_accumulators(time, flux, periods, n_bins, t_ref, flux_err = None, flux_offset = 1., chunk_size = 500):
+    """
+    Phase-binned sums of weights and weighted flux at every trial period
+    n.b. Periods are processed in chunks to keep memory bounded, and the flux is
+    taken relative to flux_offset so the sums can be kept in single precision
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float) - flux_offset
+    w = _weights(time, flux_err)
+    wy = w*flux
+    n_periods = len(periods)
+    sum_w = np.zeros((n_periods, n_bins), dtype=np.float32)
+    sum_wy = np.zeros((n_periods, n_bins), dtype=np.float32)
+    for start in range(0, n_periods, chunk_size):
+        p = periods[start:start+chunk_size]
+        flat = phase_bin_indices(time, p, n_bins, t_ref)
+        sum_w[start:start+len(p)] = binned_sums(flat, w, len(p), n_bins)
+        sum_wy[start:start+len(p)] = binned_sums(flat, wy, len(p), n_bins)
+    return {'W':np.sum(w), 'Y':np.sum(wy), 'YY':np.sum(w*flux**2), 'sum_w':sum_w, 'sum_wy':sum_wy}
+
+def _add(total, new):
+    if total is None:
+        return new
+    return {key:total[key] + new[key] for key in total}
+
+def add_ls_sector(state, sector, time, flux, flux_err = None):
+    """
+    Adds one sector's LS sums to the state, unless it is already included
+    """
+    if sector in state['ls_sectors']:
+        return state
+    state['ls'] = _add(state['ls'], ls_accumulators(time, flux, state['freq'], flux_err))
+    state['ls_sectors'].append(sector)
+    return state
+
+def add_bls_sector(state, sector, time, flux, flux_err = None):
+    """
+    Adds one sector's phase-binned BLS sums to the state, unless it is already
+    included
+    """
+    if sector in state['bls_sectors']:
+        return state
+    # The fixed period grid cannot follow a transit across too long a baseline, so refuse rather than smear it out
+    t_span = state.get('t_span', [np.inf, -np.inf])
+    t_span = [min(t_span[0], np.min(time)), max(t_span[1], np.max(time))]
+    max_baseline = resolvable_baseline(state['periods'], state.get('min_duration', 0.05))
+    if t_span[1] - t_span[0] > max_baseline:
+        raise ValueError('Sector {} would make the baseline {:.1f}d, but the stored period grid only resolves {:.1f}d; '
+                         'start a new state with a larger baseline'.format(sector, t_span[1] - t_span[0], max_baseline))
+    state['t_span'] = t_span
+    state['bls'] = _add(state['bls'], bls_accumulators(time, flux, state['periods'], state['n_bins'], state['t_ref'], flux_err, state['flux_offset']))
+    state['bls_sectors'].append(sector)
+    return state
+
+def ls_power_from_state(state):
+    """
+    Floating-mean LS power (standard normalisation) of all sectors in the state
+    """
+    acc = state['ls']
+    W = acc['W']
+    Y = acc['Y']/W
+    YY = acc['YY']/W - Y**2
+    S = acc['S']/W
+    C = acc['C']/W
+    YS = acc['Ys']/W - Y*S
+    YC = acc['Yc']/W - Y*C
+    SS = 0.5*(1 - acc['C2']/W) - S*S
+    CC = 0.5*(1 + acc['C2']/W) - C*C
+    CS = 0.5*acc['S2']/W - C*S
+    D = CC*SS - CS**2
+    return (SS*YC**2 + CC*YS**2 - 2*CS*YC*YS)/(YY*D)
+
+def new_best(n_periods):
+    """
+    Empty record of the best box at each trial period, for update_best
+    """
+    best = {key:np.zeros(n_periods) for key in ['power','depth','depth_err','duration','transit_time','depth_snr']}
+    best['power'][:] = -np.inf
+    return best
+
+def update_best(best, start, p, power, depth, ivar, k, n_bins, t_ref):
+    """
+    Keeps the best box of one trial duration where it beats the best so far.
+    power, depth and ivar are (period x phase bin) arrays for the chunk of
+    periods p starting at index 'start'; k is the box length in bins.
+    """
+    s = np.argmax(power, axis=1)
+    row_power = power[np.arange(len(p)), s]
+    better = row_power > best['power'][start:start+len(p)]
+    idx = np.where(better)[0] + start
+    sel = s[better]
+    row_depth = depth[better, sel]
+    row_ivar = ivar[better, sel]
+    best['power'][idx] = row_power[better]
+    best['depth'][idx] = row_depth
+    best['depth_err'][idx] = 1/np.sqrt(row_ivar)
+    best['depth_snr'][idx] = row_depth*np.sqrt(row_ivar)
+    best['duration'][idx] = k[better]*p[better]/n_bins
+    best['transit_time'][idx] = t_ref + (sel + 0.5*k[better])/n_bins*p[better]
+    return best
+
+def best_results(periods, best, unit = None):
+    """
+    The best boxes as the results object of BoxLeastSquares.power
+    """
+    best['power'][~np.isfinite(best['power'])] = 0.
+    if unit is not None:
+        periods = periods*unit
+        best['duration'] = best['duration']*unit
+        best['transit_time'] = best['transit_time']*unit
+    return BoxLeastSquaresResults('likelihood', periods, best['power'], best['depth'], best['depth_err'],
+                                  best['duration'], best['transit_time'], best['depth_snr'], best['power'])
+
+def binned_bls(periods, sum_w, sum_wy, W, Y, t_ref, durations, m_star = np.nan, r_star = np.nan, unit = None, chunk_size = 2000):
+    """
+    BLS (likelihood objective) evaluated from phase-binned sums, returning the
+    same results object as BoxLeastSquares.power
+
+    Each trial duration is rounded to a whole number of phase bins at each
+    period. If m_star and r_star (solar units) are given, durations outside the
+    plausible range for the star are skipped as in stellar_bls_autopower. If a
+    time unit is given (e.g. u.day) the periods, durations and transit times
+    carry it, as needed by BoxLeastSquares.compute_stats.
+    """
+    periods = np.asarray(periods, dtype=float)
+    durations = np.asarray(getattr(durations, 'value', durations), dtype=float)
+    n_periods, n_bins = sum_w.shape
+    y_mean = Y/W
+
+    if np.isfinite(m_star) and np.isfinite(r_star):
+        t_min, t_max = transit_duration_bounds(periods, m_star, r_star)
+    else:
+        t_min = np.zeros(n_periods)
+        t_max = np.full(n_periods, np.inf)
+
+    best = new_best(n_periods)
+    starts = np.arange(n_bins)
+    for start in range(0, n_periods, chunk_size):
+        rows = slice(start, start+chunk_size)
+        p = periods[rows]
+        w = sum_w[rows].astype(float)
+        wy = sum_wy[rows].astype(float) - w*y_mean
+        # Cumulative sums over the phase bins, wrapped round once
+        cw = np.concatenate((np.zeros((len(p),1)), np.cumsum(np.hstack((w, w)), axis=1)), axis=1)
+        cwy = np.concatenate((np.zeros((len(p),1)), np.cumsum(np.hstack((wy, wy)), axis=1)), axis=1)
+        for d in durations:
+            allowed = (d >= t_min[rows]) & (d <= t_max[rows])
+            if not np.any(allowed):
+                continue
+            k = np.clip(np.round(d/p*n_bins).astype(int), 1, n_bins//2)
+            ends = starts[None,:] + k[:,None]
+            w_in = np.take_along_axis(cw, ends, axis=1) - cw[:,:n_bins]
+            wy_in = np.take_along_axis(cwy, ends, axis=1) - cwy[:,:n_bins]
+            w_out = W - w_in
+            good = (w_in > 0) & (w_out > 0) & (wy_in < 0)
+            ivar = np.where(good, w_in*w_out/W, 0.)
+            depth = np.where(good, -wy_in/np.where(good, ivar, 1.), 0.)
+            power = 0.5*depth**2*ivar
+            power[~allowed] = -np.inf
+            update_best(best, start, p, power, depth, ivar, k, n_bins, t_ref)
+    return best_results(periods, best, unit)
+
+def bls_power_from_state(state, durations, m_star = np.nan, r_star = np.nan, unit = None):
+    """
+    BLS periodogram of all sectors in the state
+    """
+    acc = state['bls']
+    return binned_bls(state['periods'], acc['sum_w'], acc['sum_wy'], acc['W'], acc['Y'], state['t_ref'],
+                      durations, m_star, r_star, unit)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 16:05:39 2026
+planet_population.py
+
+Reproducible batches of planets for population-level injection campaigns.
+
+Planets are drawn either from the exoplanet archive table used by the
+'exo_archive' injections or from parametric period and radius distributions.
+Every task of a campaign has its own generator, seeded from the campaign
+seed and the task number, so a task always gets the same planets whichever
+worker runs it and in whatever order. Batches are dicts of parameter arrays
+(per, rp, a, inc, ecc, t0), one entry per planet, which ffi_lowess_detrend
+takes with injected_planet = 'population'.
+
+@author: mbattley
+"""
+
+import numpy as np
+import batman
+from stellar_params import load_catalog, EXO_ARCHIVE_FILE, EXO_ARCHIVE_KEYS
+from transit_search import scaled_semi_major_axis, r_Sun
+
+########################## Constants ##########################################
+
+r_Jup = 69911  #km
+au = 149597871 #km
+
+###############################################################################
+
+def task_rng(seed, task_id):
+    """
+    Generator for one task of a campaign, independent of all other tasks
+    """
+    return np.random.default_rng([int(seed), int(task_id)])
+
+def _draw(rng, n, value_range, distribution):
+    low, high = value_range
+    if distribution == 'loguniform':
+        return np.exp(rng.uniform(np.log(low), np.log(high), n))
+    elif distribution == 'uniform':
+        return rng.uniform(low, high, n)
+    else:
+        raise NameError('Invalid distribution: {}'.format(distribution))
+
+def archive_population(n_planets, rng, filename = EXO_ARCHIVE_FILE):
+    """
+    n_planets drawn (with replacement) from the exoplanet archive table, with
+    radius and orbital separation relative to their own host star as in the
+    'exo_archive' injections. Planets missing a period, radius or separation
+    are never drawn.
+    """
+    data = load_catalog(filename, EXO_ARCHIVE_KEYS)['table']
+    column = lambda name: np.asarray(np.ma.filled(np.ma.asarray(data[name], dtype=float), np.nan))
+    per = column('pl_orbper')
+    rp = column('pl_radj')*r_Jup/(column('st_rad')*r_Sun)
+    a = column('pl_orbsmax')*au/(column('st_rad')*r_Sun)
+    inc = column('pl_orbincl')
+    ecc = column('pl_orbeccen')
+    usable = np.where(np.isfinite(per) & np.isfinite(rp) & np.isfinite(a))[0]
+    rows = usable[rng.integers(0, len(usable), n_planets)]
+    return {'per':per[rows], 'rp':rp[rows], 'a':a[rows],
+            'inc':np.where(np.isfinite(inc[rows]), inc[rows], 90.),
+            'ecc':np.where(np.isfinite(ecc[rows]), ecc[rows], 0.),
+            'archive_row':rows}
+
+def parametric_population(n_planets, rng, period_range = (0.5, 14.), rp_range = (0.01, 0.2), period_distribution = 'loguniform',
+                          rp_distribution = 'loguniform', m_star = np.nan, r_star = np.nan):
+    """
+    n_planets with periods (days) and radius ratios drawn from 'uniform' or
+    'loguniform' distributions; a from Kepler's third law for the given star
+    (solar units), 17 stellar radii if unknown, on circular edge-on orbits
+    """
+    per = _draw(rng, n_planets, period_range, period_distribution)
+    rp = _draw(rng, n_planets, rp_range, rp_distribution)
+    a = scaled_semi_major_axis(per, m_star, r_star)
+    a = np.where(np.isfinite(a), a, 17.)
+    return {'per':per, 'rp':rp, 'a':a, 'inc':np.full(n_planets, 90.), 'ecc':np.zeros(n_planets)}
+
+def sample_population(task_id, n_planets, seed = 42, source = 'archive', **population_kwargs):
+    """
+    Batch of n_planets for one task: source 'archive' or 'parametric' (extra
+    keyword arguments go to archive_population/parametric_population). Epochs
+    t0 are uniform in phase, in days from the middle of the lc (as used in
+    ffi_lowess_detrend).
+    """
+    rng = task_rng(seed, task_id)
+    if source == 'archive':
+        batch = archive_population(n_planets, rng, **population_kwargs)
+    elif source == 'parametric':
+        batch = parametric_population(n_planets, rng, **population_kwargs)
+    else:
+        raise NameError('Invalid population source: {}'.format(source))
+    batch['t0'] = (rng.random(n_planets) - 0.5)*batch['per']
+    batch['task_id'] = np.full(n_planets, task_id)
+    return batch
+
+def campaign_batches(n_tasks, n_planets, seed = 42, source = 'archive', **population_kwargs):
+    """
+    Batches for tasks 0 to n_tasks-1; the same as calling sample_population
+    for each task separately, e.g. in different workers
+    """
+    return [sample_population(task_id, n_planets, seed, source, **population_kwargs) for task_id in range(n_tasks)]
+
+def population_params(batch, i):
+    """
+    batman parameters for planet i of a batch
+    """
+    params = batman.TransitParams()
+    params.t0 = batch['t0'][i]
+    params.per = batch['per'][i]
+    params.rp = batch['rp'][i]
+    params.a = batch['a'][i]
+    params.inc = batch['inc'][i]
+    params.ecc = batch['ecc'][i]
+    params.w = 90.
+    params.limb_dark = "nonlinear"
+    params.u = [0.5, 0.1, 0.1, -0.1]
+    return params
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:20:53 2026
+quicklook_search.py
+
+Time-budgeted ("anytime") quick-look transit search for triaging new data.
+
+Each target is detrended and searched in progressively finer stages (heavily
+binned, then coarse, then the full-cadence search as in ffi_lowess_detrend).
+Before each stage its cost (detrending and search) is predicted from the
+previous one, using only the times and period grid, and the stage
+is skipped if it would overrun the target's time budget; within a stage the
+period grid is searched in chunks so that a stage which runs over can be cut
+short. The candidates of the most refined stage reached are returned along
+with a record of how far the search got.
+
+quicklook_batch shares a fixed total time between all the targets of a
+sector, passing any time a target did not use on to the rest.
+
+@author: mbattley
+"""
+
+import time as timer
+import numpy as np
+import astropy.units as u
+import statsmodels.api as sm
+from astropy.table import Table
+from astropy.timeseries import BoxLeastSquares
+from transit_search import extract_candidates, _concatenate_results
+from utility_belt import bin_by_time
+
+# n.b. cadence = None means full cadence
+QUICKLOOK_STAGES = [{'name':'binned', 'cadence':0.04, 'n_durations':5, 'frequency_factor':5.},
+                    {'name':'coarse', 'cadence':0.0125, 'n_durations':20, 'frequency_factor':2.},
+                    {'name':'fine', 'cadence':None, 'n_durations':100, 'frequency_factor':1.}]
+
+def quicklook_detrend(time, flux, window_length = 0.5):
+    """
+    Quick lowess detrending of a whole lc, with a smoothing window of about
+    window_length days. Returns the residual (relative) flux.
+    """
+    frac = min(window_length/(time[-1] - time[0]), 1.)
+    # n.b. delta skips the full local fit for points within a tenth of the window
+    trend = sm.nonparametric.lowess(flux, time, frac=frac, delta=0.1*window_length, return_sorted=False)
+    return flux/trend
+
+def anytime_quicklook(time, flux, time_budget = 60., min_duration = 0.05, max_duration = 1., rot_period = None, n_candidates = 3, window_length = 0.5, stages = QUICKLOOK_STAGES, n_chunks = 10):
+    """
+    Runs the quick-look stages on one lc until they are all done or the time
+    budget (seconds) runs out
+
+    Returns the candidate table of the most refined stage completed (or, if
+    not even the first stage finished, of the part of its period grid that
+    was searched) and a progress dict recording each stage's status ('done',
+    'partial' or 'skipped'), the fraction of its period grid searched and the
+    time it took.
+    """
+    start = timer.time()
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(time) & np.isfinite(flux)
+    time = time[good]
+    flux = flux[good]
+
+    candidates = None
+    progress = {'budget':time_budget, 'stage_reached':None, 'complete':False, 'stages':[]}
+    last_costs = None
+    last_work = None
+    for stage in stages:
+        stage_start = timer.time()
+        remaining = time_budget - (stage_start - start)
+
+        # Period grid and size of this stage, from the times alone
+        if stage['cadence'] is not None and stage['cadence'] > np.median(np.diff(time)):
+            n_points = len(np.unique(np.floor((time - time[0])/stage['cadence'])))
+        else:
+            n_points = len(time)
+        durations = np.linspace(min_duration, max_duration, stage['n_durations'])*u.day
+        periods = BoxLeastSquares(time*u.day, np.ones(len(time))).autoperiod(durations, minimum_n_transit = 3, frequency_factor = stage['frequency_factor'])
+
+        # Predict the cost of this stage from the last one, before binning or detrending anything
+        # n.b. BLS cost is dominated by the loop over durations on its fine phase grid, not the number of points,
+        #      while the lowess detrending scales with the number of points
+        work = (float(n_points), float(len(periods))*len(durations))
+        if last_costs is not None and sum(c*w/lw for c, w, lw in zip(last_costs, work, last_work)) > remaining:
+            progress['stages'].append({'name':stage['name'], 'status':'skipped', 'fraction':0., 'time':0.})
+            break
+
+        # Data for this stage
+        if n_points < len(time):
+            stage_time, stage_flux, stage_err = bin_by_time(time, flux, stage['cadence'])
+        else:
+            stage_time, stage_flux, stage_err = time, flux, None
+        model = BoxLeastSquares(stage_time*u.day, quicklook_detrend(stage_time, stage_flux, window_length), stage_err)
+        detrend_time_used = timer.time() - stage_start
+
+        chunks = []
+        for chunk_periods in np.array_split(periods, n_chunks):
+            if len(chunk_periods) == 0:
+                continue
+            chunks.append(model.power(chunk_periods, durations[durations.value < chunk_periods.value.min()]))
+            if timer.time() - start > time_budget:
+                break
+        fraction = float(sum(len(c.period) for c in chunks))/len(periods)
+        stage_time_used = timer.time() - stage_start
+        status = 'done' if fraction == 1. else 'partial'
+        progress['stages'].append({'name':stage['name'], 'status':status, 'fraction':fraction, 'time':stage_time_used})
+
+        # A partial stage only replaces the results of a completed one if there are none yet
+        if status == 'done' or candidates is None:
+            results = _concatenate_results(chunks)
+            candidates = extract_candidates(results, n_candidates = n_candidates, rot_period = rot_period)
+            progress['stage_reached'] = stage['name']
+        if status == 'partial':
+            break
+        last_costs = (detrend_time_used, stage_time_used - detrend_time_used)
+        last_work = work
+
+    progress['complete'] = len(progress['stages']) == len(stages) and progress['stages'][-1]['status'] == 'done'
+    progress['time_used'] = timer.time() - start
+    return candidates, progress
+
+def quicklook_batch(lightcurves, total_budget, **quicklook_kwargs):
+    """
+    Quick-look search of every target in lightcurves (dict of target_ID ->
+    (time, flux)) within total_budget seconds overall. Each target gets an
+    equal share of the time left, so time saved on one target goes to the rest.
+
+    Returns a summary table with the best candidate and the stage reached for
+    each target, and a dict of the full candidate tables and progress records
+    """
+    start = timer.time()
+    summary = Table(names=['target_ID','period','transit_time','duration','depth','depth_snr','stage_reached','complete','time_used'],
+                    dtype=['U40','f8','f8','f8','f8','f8','U10','bool','f8'])
+    details = {}
+    target_IDs = list(lightcurves)
+    for i, target_ID in enumerate(target_IDs):
+        budget = (total_budget - (timer.time() - start))/(len(target_IDs) - i)
+        time, flux = lightcurves[target_ID]
+        candidates, progress = anytime_quicklook(time, flux, time_budget = max(budget, 0.), **quicklook_kwargs)
+        details[target_ID] = (candidates, progress)
+        if candidates is not None and len(candidates) > 0:
+            best = [candidates[field][0] for field in ['period','transit_time','duration','depth','depth_snr']]
+            best = [getattr(value, 'value', value) for value in best]
+        else:
+            best = [np.nan]*5
+        summary.add_row([target_ID] + best + [str(progress['stage_reached']), progress['complete'], progress['time_used']])
+    return summary, details
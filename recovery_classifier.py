@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:12:27 2026
+recovery_classifier.py
+
+Classifies injection-recovery results and builds completeness matrices from
+whole result tables at once, rather than row by row.
+
+An injection counts as recovered if the highest BLS peak lies within the
+tolerance of the injected period or one of its n/m aliases (by default P, 2P
+and P/2, as in automated_sensitivity_analysis_eyeball), or if the 2nd/3rd
+highest peaks lie within the tolerance of the injected period itself.
+Optionally the depth and epoch of the highest peak must also agree with the
+injected ones.
+
+@author: mbattley
+"""
+
+import numpy as np
+
+# (n, m) pairs: the found period matches injected_period*n/m
+PRIMARY_ALIASES = ((1,1), (2,1), (1,2))
+SECONDARY_ALIASES = ((1,1),)
+
+def match_period(found_period, injected_period, tolerance = 0.02, aliases = ((1,1),)):
+    """
+    Boolean array, True where found_period is within tolerance (days; scalar
+    or one per row) of injected_period*n/m for any (n, m) in aliases.
+    nan periods never match.
+    """
+    found_period = np.asarray(found_period, dtype=float)
+    injected_period = np.asarray(injected_period, dtype=float)
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=float), injected_period.shape)
+    ratios = np.array([n/m for n, m in aliases], dtype=float)
+    return np.any(np.abs(found_period[:,None] - injected_period[:,None]*ratios[None,:]) < tolerance[:,None], axis=1)
+
+def classify_recoveries(injected_period, found_periods, tolerance = 0.02, aliases = PRIMARY_ALIASES, secondary_aliases = SECONDARY_ALIASES,
+                        injected_depth = None, found_depth = None, depth_tolerance = 0.5,
+                        injected_t0 = None, found_t0 = None, epoch_tolerance = None):
+    """
+    Recovered (bool) array for a set of injections
+
+    found_periods is an (N, K) array (or list of K columns) of the highest K
+    peaks of each search, highest first. The highest peak is compared with
+    all the aliases, the others with secondary_aliases only. If depths are
+    given the highest peak's depth must be within depth_tolerance (fractional)
+    of the injected depth, and if epochs and epoch_tolerance (days) are given
+    its epoch must lie within epoch_tolerance of an injected transit.
+    n.b. Depth and epoch checks only apply to matches of the highest peak,
+         which is the only one these are measured for
+    """
+    injected_period = np.asarray(injected_period, dtype=float)
+    if isinstance(found_periods, (list, tuple)):
+        found_periods = np.column_stack(found_periods)
+    found_periods = np.asarray(found_periods, dtype=float).reshape(len(injected_period), -1)
+
+    top = match_period(found_periods[:,0], injected_period, tolerance, aliases)
+    if injected_depth is not None and found_depth is not None:
+        ratio = np.asarray(found_depth, dtype=float)/np.asarray(injected_depth, dtype=float)
+        top &= np.abs(ratio - 1) < depth_tolerance
+    if injected_t0 is not None and found_t0 is not None and epoch_tolerance is not None:
+        # n.b. Epochs are compared modulo the shorter of the two periods, so P/2 aliases pass on either half
+        fold = np.minimum(found_periods[:,0], injected_period)
+        offset = np.mod(np.asarray(found_t0, dtype=float) - np.asarray(injected_t0, dtype=float) + 0.5*fold, fold) - 0.5*fold
+        top &= np.abs(offset) < epoch_tolerance
+
+    recovered = top
+    for k in range(1, found_periods.shape[1]):
+        recovered = recovered | match_period(found_periods[:,k], injected_period, tolerance, secondary_aliases)
+    return recovered
+
+def classify_table(table, injected_col = 'Injected Period', found_cols = ('Max Period', '2nd highest period', '3rd Highest Period'),
+                   recovered_col = 'recovered', **classify_kwargs):
+    """
+    Adds a boolean recovered column to a results table (astropy Table or
+    dict of columns), using classify_recoveries; returns the table
+    """
+    table[recovered_col] = classify_recoveries(table[injected_col], [table[col] for col in found_cols], **classify_kwargs)
+    return table
+
+def completeness_matrix(row_values, col_values, recovered, groups = None, row_bins = None, col_bins = None):
+    """
+    Fraction recovered in each (row, column) cell, e.g. (period, radius ratio)
+
+    Rows and columns are the unique values of row_values/col_values, or bins
+    given by the edges row_bins/col_bins (values outside are dropped). If
+    groups (e.g. sector) is given a separate matrix is made for each group
+    on the same cells.
+
+    Returns (rows, cols, completeness, n_injected) where rows/cols are the
+    cell values (or bin edges), and completeness and n_injected have shape
+    (n_rows, n_cols), or (n_groups, n_rows, n_cols) with a 4th returned item
+    listing the groups. Empty cells have nan completeness.
+    """
+    def cell_index(values, bins):
+        values = np.asarray(values)
+        if bins is None:
+            labels, index = np.unique(values, return_inverse=True)
+            return labels, index.ravel(), len(labels)
+        index = np.digitize(values, bins) - 1
+        index[(index < 0) | (index >= len(bins) - 1)] = -1
+        return np.asarray(bins), index, len(bins) - 1
+
+    rows, row_index, n_rows = cell_index(row_values, row_bins)
+    cols, col_index, n_cols = cell_index(col_values, col_bins)
+    if groups is None:
+        group_labels, group_index, n_groups = None, np.zeros(len(row_index), dtype=int), 1
+    else:
+        group_labels, group_index, n_groups = cell_index(groups, None)
+    keep = (row_index >= 0) & (col_index >= 0)
+    flat = (group_index[keep]*n_rows + row_index[keep])*n_cols + col_index[keep]
+    size = n_groups*n_rows*n_cols
+    n_injected = np.bincount(flat, minlength=size).reshape(n_groups, n_rows, n_cols)
+    n_recovered = np.bincount(flat, weights=np.asarray(recovered, dtype=float)[keep], minlength=size).reshape(n_groups, n_rows, n_cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        completeness = np.where(n_injected > 0, n_recovered/n_injected, np.nan)
+    if groups is None:
+        return rows, cols, completeness[0], n_injected[0]
+    return rows, cols, completeness, n_injected, group_labels
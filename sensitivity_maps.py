@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 14:18:50 2026
+sensitivity_maps.py
+
+Completeness maps from large injection-recovery campaigns.
+
+Result files (csv, or the FITS parts written by injection_recovery) are read
+a chunk at a time and each chunk is added into fixed histograms of injected
+and recovered planets over (period, radius ratio) and any further
+dimensions, such as sector or a stellar property. Memory therefore depends
+on the number of cells, not the number of rows. Maps are drawn in the style
+of categorical_heatmap, optionally with completeness shown in a few discrete
+colour categories.
+
+@author: mbattley
+"""
+
+import os
+import glob
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib import colors
+from astropy.io import ascii
+from astropy.table import Table
+from recovery_classifier import classify_recoveries
+
+def iter_result_chunks(filenames, chunk_size = 50000000):
+    """
+    Yields the results in one or more csv or FITS files as a series of
+    tables; csv files are read in chunks of about chunk_size bytes
+    """
+    if isinstance(filenames, str):
+        filenames = sorted(glob.glob(filenames)) if not os.path.exists(filenames) else [filenames]
+    for filename in filenames:
+        if filename.endswith('.fits'):
+            yield Table.read(filename)
+        else:
+            for chunk in ascii.read(filename, format='csv', guess=False,
+                                    fast_reader={'chunk_size':int(chunk_size), 'chunk_generator':True}):
+                yield chunk
+
+def new_sensitivity_map(dimensions):
+    """
+    Empty map over the given dimensions, a list of (column, edges, kind)
+    where kind is 'bins' (edges are bin edges) or 'values' (edges are the
+    categories, e.g. sectors or the injected periods of a grid)
+    """
+    shape = tuple(len(edges) - 1 if kind == 'bins' else len(edges) for _, edges, kind in dimensions)
+    return {'dimensions':dimensions, 'n_injected':np.zeros(shape, dtype=np.int64),
+            'n_recovered':np.zeros(shape, dtype=np.int64), 'n_rows':0, 'n_outside':0}
+
+def add_results(sensitivity_map, table, recovered_col = 'recovered', **classify_kwargs):
+    """
+    Adds a table of results to the map. If recovered_col is not a column it
+    is worked out with classify_recoveries (extra keyword arguments give its
+    injected_period and found_periods column names). Rows outside the map
+    are counted in n_outside.
+    """
+    dimensions = sensitivity_map['dimensions']
+    if recovered_col in table.colnames:
+        recovered = np.asarray(table[recovered_col], dtype=bool)
+    else:
+        injected_col = classify_kwargs.pop('injected_col', 'Injected Period')
+        found_cols = classify_kwargs.pop('found_cols', ('Max Period', '2nd highest period', '3rd Highest Period'))
+        recovered = classify_recoveries(table[injected_col], [table[col] for col in found_cols], **classify_kwargs)
+
+    flat = np.zeros(len(table), dtype=np.int64)
+    inside = np.ones(len(table), dtype=bool)
+    for (column, edges, kind), size in zip(dimensions, sensitivity_map['n_injected'].shape):
+        values = np.asarray(table[column])
+        if kind == 'bins':
+            index = np.searchsorted(np.asarray(edges), values, side='right') - 1
+            # n.b. The last bin includes its upper edge, as in np.histogram
+            index[values == edges[-1]] = size - 1
+        else:
+            categories = np.asarray(edges)
+            order = np.argsort(categories)
+            position = np.clip(np.searchsorted(categories[order], values), 0, size - 1)
+            index = np.where(categories[order][position] == values, order[position], -1)
+        inside &= (index >= 0) & (index < size)
+        flat = flat*size + np.clip(index, 0, size - 1)
+
+    n_cells = sensitivity_map['n_injected'].size
+    sensitivity_map['n_injected'] += np.bincount(flat[inside], minlength=n_cells).reshape(sensitivity_map['n_injected'].shape)
+    sensitivity_map['n_recovered'] += np.bincount(flat[inside & recovered], minlength=n_cells).reshape(sensitivity_map['n_injected'].shape)
+    sensitivity_map['n_rows'] += len(table)
+    sensitivity_map['n_outside'] += int(np.sum(~inside))
+    return sensitivity_map
+
+def build_sensitivity_map(filenames, dimensions, chunk_size = 50000000, **add_kwargs):
+    """
+    Streams all the results in filenames into a new map over dimensions
+    """
+    sensitivity_map = new_sensitivity_map(dimensions)
+    for chunk in iter_result_chunks(filenames, chunk_size):
+        add_results(sensitivity_map, chunk, **add_kwargs)
+    return sensitivity_map
+
+def completeness(sensitivity_map, keep = (0, 1), select = None):
+    """
+    Completeness over the dimensions numbered in keep (summing over the
+    rest), with select = {dimension number:index} fixing others first, e.g.
+    {2:0} for the first sector. Returns (completeness, n_injected); nan
+    where nothing was injected.
+    """
+    n_injected = sensitivity_map['n_injected']
+    n_recovered = sensitivity_map['n_recovered']
+    if select is not None:
+        slices = tuple(select.get(d, slice(None)) for d in range(n_injected.ndim))
+        n_injected = n_injected[slices]
+        n_recovered = n_recovered[slices]
+        remaining = [d for d in range(sensitivity_map['n_injected'].ndim) if d not in select]
+        keep = [remaining.index(d) for d in keep]
+    others = tuple(d for d in range(n_injected.ndim) if d not in keep)
+    n_injected = n_injected.sum(axis=others)
+    n_recovered = n_recovered.sum(axis=others)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n_injected > 0, n_recovered/n_injected, np.nan), n_injected
+
+def axis_labels(sensitivity_map, dimension, fmt = '{:g}'):
+    """
+    Tick labels for one dimension of a map: the categories, or 'low-high'
+    for bins
+    """
+    _, edges, kind = sensitivity_map['dimensions'][dimension]
+    if kind == 'bins':
+        return [(fmt + '-' + fmt).format(low, high) for low, high in zip(edges[:-1], edges[1:])]
+    return [fmt.format(value) if not isinstance(value, str) else value for value in edges]
+
+def plot_completeness_map(data, row_labels, col_labels, ax = None, categories = None, category_colours = None, cmap = 'viridis',
+                          annotate = True, valfmt = '{x:.2f}', cbarlabel = 'Fraction of injected planets recovered', xlabel = '', ylabel = '', title = ''):
+    """
+    Heatmap of a completeness matrix (rows x columns), laid out as in
+    categorical_heatmap. If categories (edges in completeness, e.g.
+    [0, 0.25, 0.5, 0.75, 1]) are given the cells are coloured by category,
+    with category_colours or colours taken from cmap.
+    """
+    if ax is None:
+        ax = plt.gca()
+    data = np.ma.masked_invalid(data)
+    if categories is not None:
+        if category_colours is None:
+            category_colours = plt.get_cmap(cmap)(np.linspace(0, 1, len(categories) - 1))
+        im = ax.imshow(data, cmap=colors.ListedColormap(category_colours), norm=colors.BoundaryNorm(categories, len(categories) - 1))
+    else:
+        im = ax.imshow(data, cmap=cmap, vmin=0, vmax=1)
+    cbar = plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+    cbar.ax.set_ylabel(cbarlabel, rotation=-90, va="bottom")
+
+    ax.set_xticks(np.arange(data.shape[1]))
+    ax.set_yticks(np.arange(data.shape[0]))
+    ax.set_xticklabels(col_labels)
+    ax.set_yticklabels(row_labels)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    if title != '':
+        ax.set_title(title)
+    ax.tick_params(top=True, bottom=False, labeltop=True, labelbottom=False)
+    plt.setp(ax.get_xticklabels(), rotation=-30, ha="right", rotation_mode="anchor")
+    for edge, spine in ax.spines.items():
+        spine.set_visible(False)
+    ax.set_xticks(np.arange(data.shape[1]+1)-.5, minor=True)
+    ax.set_yticks(np.arange(data.shape[0]+1)-.5, minor=True)
+    ax.grid(which="minor", color="w", linestyle='-', linewidth=3)
+    ax.tick_params(which="minor", bottom=False, left=False)
+
+    if annotate == True:
+        formatter = matplotlib.ticker.StrMethodFormatter(valfmt)
+        # n.b. A BoundaryNorm gives the category number rather than a 0-1 level
+        n_levels = 1 if categories is None else max(len(categories) - 2, 1)
+        for i in range(data.shape[0]):
+            for j in range(data.shape[1]):
+                if data.mask[i, j] == False:
+                    colour = "black" if im.norm(data[i, j])/n_levels >= 0.5 else "white"
+                    ax.text(j, i, formatter(data[i, j], None), ha="center", va="center", color=colour)
+    return im, cbar
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 13:47:05 2026
+stellar_params.py
+
+In-memory stellar and planet parameter catalogues (BANYAN members, exoplanet
+archive) shared by the injection and search stages.
+
+Each catalogue file is read once per process and indexed by its identifier
+columns (e.g. TIC, main_id or host name) in dicts, so looking a target up
+costs the same however large the catalogue is. Optionally the parsed table
+is also kept on disk as a pickle next to the csv, which is re-used for as
+long as the csv is unchanged.
+
+@author: mbattley
+"""
+
+import os
+import pickle
+import numpy as np
+from astropy.table import Table
+
+BANYAN_FILE = 'BANYAN_XI-III_members_with_TIC.csv'
+BANYAN_KEYS = ('main_id', 'MatchID')
+EXO_ARCHIVE_FILE = 'Exoplanet Archive Planets for injection.csv'
+EXO_ARCHIVE_KEYS = ('pl_hostname',)
+
+_catalogs = {}
+
+def _key(value):
+    """
+    Normalised lookup key: stripped string, with any 'TIC' prefix removed so
+    'TIC 123' and 123 find the same star
+    """
+    key = str(value).strip()
+    if key.upper().startswith('TIC'):
+        key = key[3:].strip()
+    return key
+
+def load_catalog(filename = BANYAN_FILE, key_columns = BANYAN_KEYS, disk_cache = False):
+    """
+    Returns the catalogue in filename as a dict with the 'table' and an
+    'index' of {column:{key:[rows]}} for each of key_columns. Loaded once
+    per process; disk_cache = True also keeps a pickle of the parsed table
+    beside the csv
+    """
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+    cache_key = (path, tuple(key_columns))
+    if cache_key in _catalogs and _catalogs[cache_key]['mtime'] == mtime:
+        return _catalogs[cache_key]
+
+    table = None
+    pickle_file = path + '.pkl'
+    if disk_cache == True and os.path.exists(pickle_file) and os.path.getmtime(pickle_file) >= mtime:
+        with open(pickle_file, 'rb') as f:
+            table = pickle.load(f)
+    if table is None:
+        table = Table.read(path, format='ascii.csv')
+        if disk_cache == True:
+            with open(pickle_file + '.tmp', 'wb') as f:
+                pickle.dump(table, f)
+            os.replace(pickle_file + '.tmp', pickle_file)
+
+    index = {}
+    for column in key_columns:
+        index[column] = {}
+        if column not in table.colnames:
+            continue
+        values = table[column]
+        for row, value in enumerate(values):
+            if np.ma.is_masked(value):
+                continue
+            index[column].setdefault(_key(value), []).append(row)
+    _catalogs[cache_key] = {'table':table, 'index':index, 'mtime':mtime}
+    return _catalogs[cache_key]
+
+def find_rows(catalog, target_IDs, columns = None):
+    """
+    Rows of the catalogue holding each of target_IDs (first match, trying
+    each indexed column in turn), -1 where not found
+    """
+    if columns is None:
+        columns = list(catalog['index'])
+    rows = np.full(len(target_IDs), -1, dtype=int)
+    for i, target_ID in enumerate(target_IDs):
+        key = _key(target_ID)
+        for column in columns:
+            if key in catalog['index'][column]:
+                rows[i] = catalog['index'][column][key][0]
+                break
+    return rows
+
+def lookup(catalog, target_IDs, fields, columns = None):
+    """
+    Values of the given (numerical) fields for each of target_IDs, as a dict
+    of arrays; nan for targets not found and for missing values
+    """
+    rows = find_rows(catalog, target_IDs, columns)
+    found = rows >= 0
+    values = {}
+    for field in fields:
+        column = np.ma.filled(np.ma.asarray(catalog['table'][field], dtype=float), np.nan)
+        values[field] = np.where(found, column[np.where(found, rows, 0)], np.nan)
+    return values
+
+def stellar_masses_radii(target_IDs, filename = BANYAN_FILE, disk_cache = False):
+    """
+    Stellar masses and radii (solar units) for a list of targets, looked up
+    by main_id or TIC in the BANYAN table; nan where unknown
+    """
+    values = lookup(load_catalog(filename, BANYAN_KEYS, disk_cache), target_IDs, ['Stellar Mass', 'Stellar Radius'])
+    return values['Stellar Mass'], values['Stellar Radius']
+
+def host_planets(host_names, filename = EXO_ARCHIVE_FILE, disk_cache = False):
+    """
+    Rows of the exoplanet archive table for all planets of the given hosts
+    """
+    catalog = load_catalog(filename, EXO_ARCHIVE_KEYS, disk_cache)
+    index = catalog['index']['pl_hostname']
+    rows = [row for host in host_names for row in index.get(_key(host), [])]
+    return catalog['table'][rows]
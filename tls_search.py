@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:02:44 2026
+tls_search.py
+
+Transit Least Squares as an alternative to BLS in the transit search stage.
+
+Runs on the same cleaned and detrended residuals as the BLS search, with the
+TLS period and duration grids bounded by the stellar parameters already
+loaded for the target. The SDE periodogram is returned in the same form as
+a BLS results object and candidates are picked with extract_candidates, so
+everything downstream of the search is unchanged.
+
+@author: mbattley
+"""
+
+import numpy as np
+import multiprocessing as multip
+from astropy.timeseries import BoxLeastSquares, BoxLeastSquaresResults
+from transitleastsquares import transitleastsquares
+from transit_search import _strip_unit, extract_candidates
+
+def tls_search(time, flux, durations, m_star = np.nan, r_star = np.nan, flux_err = None, n_candidates = 3, rot_period = None, period_min = 0., period_max = np.inf, n_threads = None, oversampling_factor = 3, duration_grid_step = 1.1, stellar_tolerance = 1.5, unit = None, **tls_kwargs):
+    """
+    TLS search of a detrended lc, returning (results, candidates, tls_results)
+
+    results is a BoxLeastSquaresResults holding the TLS SDE periodogram as its
+    power. The transit time, duration, depth and depth SNR of each candidate
+    (nan elsewhere) come from a single BLS evaluation at the candidate periods
+    using the trial durations, apart from the transit time, duration and depth
+    of the TLS best peak (if kept) which take the TLS values. depth_snr is the
+    BLS value for every candidate, so they rank alike; the TLS SNR of the best
+    peak is in the candidates' tls_snr column (nan for the others). n_threads
+    sets the number of TLS threads (default all cores).
+    If m_star and r_star (solar units) are known the TLS grids assume them to
+    within a factor stellar_tolerance, otherwise the TLS defaults are used.
+    """
+    time, _ = _strip_unit(time)
+    flux = np.asarray(flux, dtype=float)
+    durations, _ = _strip_unit(durations)
+    if n_threads is None:
+        n_threads = multip.cpu_count()
+
+    if np.isfinite(m_star) and np.isfinite(r_star) and m_star > 0 and r_star > 0:
+        tls_kwargs.update({'M_star':m_star, 'M_star_min':m_star/stellar_tolerance, 'M_star_max':m_star*stellar_tolerance,
+                           'R_star':r_star, 'R_star_min':r_star/stellar_tolerance, 'R_star_max':r_star*stellar_tolerance})
+
+    model = transitleastsquares(time, flux, flux_err)
+    tls_results = model.power(period_min = period_min, period_max = period_max, use_threads = n_threads,
+                              oversampling_factor = oversampling_factor, duration_grid_step = duration_grid_step,
+                              show_progress_bar = False, **tls_kwargs)
+
+    # TLS periods come out in decreasing frequency order; keep them increasing
+    order = np.argsort(tls_results.periods)
+    periods = np.asarray(tls_results.periods, dtype=float)[order]
+    power = np.asarray(tls_results.power, dtype=float)[order]
+    fields = {key:np.full(len(periods), np.nan) for key in ['depth','depth_err','duration','transit_time','depth_snr']}
+    candidates = extract_candidates(BoxLeastSquaresResults('snr', periods, power, *[fields[key] for key in ['depth','depth_err','duration','transit_time','depth_snr']], power),
+                                    n_candidates = n_candidates, rot_period = rot_period)
+    index = np.asarray(candidates['index'])
+
+    # Fill in the transit parameters of each candidate
+    candidates['tls_snr'] = np.full(len(index), np.nan)
+    if len(index) > 0:
+        bls_durations = durations[durations < np.min(periods[index])]
+        stats = BoxLeastSquares(time, flux, flux_err).power(periods[index], bls_durations)
+        for key in fields:
+            fields[key][index] = stats[key]
+        best = index[np.argmax(power[index])]
+        if np.isclose(periods[best], tls_results.period, rtol = 1e-3):
+            fields['transit_time'][best] = tls_results.T0
+            fields['duration'][best] = tls_results.duration
+            fields['depth'][best] = 1. - tls_results.depth
+            candidates['tls_snr'][index == best] = tls_results.snr
+        for key in ['transit_time', 'duration', 'depth', 'depth_snr']:
+            candidates[key] = fields[key][index]
+
+    if unit is not None:
+        periods = periods*unit
+        fields['duration'] = fields['duration']*unit
+        fields['transit_time'] = fields['transit_time']*unit
+        for key in ['period', 'transit_time', 'duration']:
+            candidates[key].unit = unit
+    results = BoxLeastSquaresResults('snr', periods, power, fields['depth'], fields['depth_err'], fields['duration'],
+                                     fields['transit_time'], fields['depth_snr'], power)
+    return results, candidates, tls_results
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:41 2026
+transit_search.py
+
+Collects the functions used in the transit search stage of the detrending
+pipeline, so that the various versions of ffi_lowess_detrend can share them
+rather than carrying their own copies
+
+@author: mbattley
+"""
+
+import numpy as np
+from astropy.table import Table
+from scipy.signal import find_peaks, fftconvolve
+
+########################## Constants ##########################################
+
+G = 6.6743*10**-11 #m^3.kg^-1.s^-2
+m_Sun = 1.9891*10**30 #kg
+r_Sun = 695510 #km
+
+###############################################################################
+
+def _strip_unit(x):
+    """
+    Returns the bare values and unit (or None) of a possible astropy Quantity
+    """
+    if hasattr(x, 'unit'):
+        return np.asarray(x.value, dtype=float), x.unit
+    return np.asarray(x, dtype=float), None
+
+def scaled_semi_major_axis(period, m_star, r_star):
+    """
+    Semi-major axis in units of stellar radii for a circular orbit
+    n.b. Period in days, m_star and r_star in solar units
+    """
+    period = np.asarray(period, dtype=float)
+    a = ((G*m_star*m_Sun*(period*86400.)**2)/(4.*(np.pi**2)))**(1./3)
+    return a/(r_star*r_Sun*1000)
+
+def transit_duration_bounds(period, m_star, r_star, rp_max = 0.2, b_max = 0.9, tolerance = 1.5):
+    """
+    Gives the shortest and longest physically plausible transit durations (days)
+    at each trial period, for a star of given mass and radius (solar units)
+
+    The longest is a central transit of a planet of radius ratio rp_max and the
+    shortest a transit of a small planet at impact parameter b_max. Both are
+    widened by 'tolerance' to allow for errors in the stellar parameters and
+    for modest eccentricities.
+    """
+    period = np.asarray(period, dtype=float)
+    a_rs = scaled_semi_major_axis(period, m_star, r_star)
+    long_chord = np.minimum((1. + rp_max)/a_rs, 1.)
+    short_chord = np.minimum(np.sqrt(1. - b_max**2)/a_rs, 1.)
+    t_max = tolerance*period/np.pi*np.arcsin(long_chord)
+    t_min = period/np.pi*np.arcsin(short_chord)/tolerance
+    return t_min, t_max
+
+def _concatenate_results(chunks):
+    """
+    Joins the results of several BLS power calls into a single results object
+    """
+    first = chunks[0]
+    fields = ['period', 'power', 'depth', 'depth_err', 'duration', 'transit_time',
+              'depth_snr', 'log_likelihood']
+    columns = []
+    for field in fields:
+        unit = _strip_unit(first[field])[1]
+        values = np.concatenate([_strip_unit(chunk[field])[0] for chunk in chunks])
+        columns.append(values if unit is None else values*unit)
+    return type(first)(first.objective, *columns)
+
+def stellar_bls_autopower(model, durations, m_star, r_star, minimum_n_transit = 3, frequency_factor = 1.0, **bound_kwargs):
+    """
+    Drop-in replacement for model.autopower(durations, ...) which only tests the
+    trial durations that are physically plausible at each trial period for a
+    star of the given mass and radius (solar units)
+
+    The period grid is the same one autopower would use, so nothing is lost
+    relative to the full search. Periods which share the same set of allowed
+    durations are searched together in one call to model.power. If the
+    stellar parameters are not known (nan) the full grid is searched as before.
+    """
+    if not np.isfinite(m_star) or not np.isfinite(r_star) or m_star <= 0 or r_star <= 0:
+        return model.autopower(durations, minimum_n_transit = minimum_n_transit, frequency_factor = frequency_factor)
+
+    periods = model.autoperiod(durations, minimum_n_transit = minimum_n_transit, frequency_factor = frequency_factor)
+    period_values, _ = _strip_unit(periods)
+    duration_values, _ = _strip_unit(durations)
+
+    t_min, t_max = transit_duration_bounds(period_values, m_star, r_star, **bound_kwargs)
+    allowed = (duration_values[None,:] >= t_min[:,None]) & (duration_values[None,:] <= t_max[:,None])
+
+    # Always keep the trial duration closest to the allowed range
+    clipped = np.clip(duration_values[None,:], t_min[:,None], t_max[:,None])
+    closest = np.argmin(np.abs(duration_values[None,:] - clipped), axis=1)
+    allowed[np.arange(len(period_values)), closest] = True
+
+    # Also never test durations longer than the period itself
+    allowed &= duration_values[None,:] < period_values[:,None]
+
+    # Group consecutive periods with identical allowed duration sets
+    changes = np.any(allowed[1:] != allowed[:-1], axis=1)
+    starts = np.concatenate(([0], np.where(changes)[0] + 1))
+    ends = np.concatenate((starts[1:], [len(period_values)]))
+
+    chunks = []
+    for start, end in zip(starts, ends):
+        chunk_periods = periods[start:end]
+        chunk_durations = durations[allowed[start]]
+        chunks.append(model.power(chunk_periods, chunk_durations))
+
+    return _concatenate_results(chunks)
+
+def extract_candidates(results, n_candidates = 3, rot_period = None, harmonics = (1./3, 0.5, 0.75, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 9., 10.), rot_harmonics = None, tolerance = 0.1, distance = 10):
+    """
+    Picks out the n_candidates strongest independent peaks of a BLS periodogram
+
+    Peaks within 'tolerance' days of any multiple in 'harmonics' of the stellar
+    rotation period, or of an already selected peak, are skipped. Peaks are
+    found and masked with array operations, so the cost hardly depends on
+    n_candidates.
+
+    Returns an astropy Table with one row per candidate, strongest first,
+    including the index of each candidate in the original results arrays
+    """
+    power, _ = _strip_unit(results.power)
+    periods, _ = _strip_unit(results.period)
+    harmonics = np.asarray(harmonics, dtype=float)
+    if rot_harmonics is None:
+        rot_harmonics = harmonics
+    rot_harmonics = np.asarray(rot_harmonics, dtype=float)
+
+    # Local maxima of the periodogram, strongest first
+    # n.b. find_peaks never returns the end points, so a global maximum on an edge of the grid is added back
+    #      (as the old argmax pick would have found it)
+    peaks = find_peaks(power, distance = distance)[0]
+    top = np.argmax(power)
+    if top == 0 or top == len(power) - 1:
+        peaks = np.append(peaks, top)
+    peaks = peaks[np.argsort(power[peaks])[::-1]]
+    peak_periods = periods[peaks]
+
+    # Remove all peaks lying close to harmonics of the rotation period
+    available = np.ones(len(peaks), dtype=bool)
+    if rot_period is not None and np.isfinite(rot_period):
+        rot_windows = rot_period*rot_harmonics
+        near_rot = np.abs(peak_periods[:,None] - rot_windows[None,:]) < tolerance
+        available &= ~np.any(near_rot, axis=1)
+
+    # Take the strongest remaining peak and mask its harmonics in one step
+    selected = []
+    while len(selected) < n_candidates and np.any(available):
+        best = np.argmax(available)
+        selected.append(peaks[best])
+        windows = peak_periods[best]*harmonics
+        available &= ~np.any(np.abs(peak_periods[:,None] - windows[None,:]) < tolerance, axis=1)
+        available[best] = False
+
+    selected = np.array(selected, dtype=int)
+    candidates = Table()
+    candidates['rank'] = np.arange(1, len(selected)+1)
+    candidates['index'] = selected
+    for field in ['period', 'power', 'transit_time', 'duration', 'depth', 'depth_snr']:
+        values, unit = _strip_unit(results[field])
+        candidates[field] = values[selected]
+        if unit is not None:
+            candidates[field].unit = unit
+
+    return candidates
+
+def refine_candidates(model, results, candidates, durations):
+    """
+    Re-evaluates the candidates with another BoxLeastSquares model (e.g. the
+    full-cadence lc after searching a binned copy), updating the transit time,
+    duration, depth and depth SNR of each in both the candidate table and the
+    results arrays. Periods and search power are left as found.
+    """
+    index = np.asarray(candidates['index'])
+    if len(index) == 0:
+        return candidates
+    periods = results.period[index]
+    duration_values, _ = _strip_unit(durations)
+    stats = model.power(periods, durations[duration_values < np.min(_strip_unit(periods)[0])])
+    for field in ['transit_time', 'duration', 'depth', 'depth_err', 'depth_snr']:
+        results[field][index] = stats[field]
+        candidates_values, unit = _strip_unit(stats[field])
+        if field in candidates.colnames:
+            candidates[field] = candidates_values
+            candidates[field].unit = unit
+    return candidates
+
+def vet_candidates(time, flux, candidates, flux_err = None, n_phase_bins = 100):
+    """
+    Vetting statistics for all candidates from extract_candidates at once
+
+    The lc is folded on every candidate period in one array operation (phase
+    convention as in phase_fold_plot, i.e. transit at phase 0.5) and the
+    following are found for each candidate:
+        depth, depth_err, snr          - mean in-transit depth and its SNR
+        depth_odd, depth_even          - depths of odd and even transits
+        odd_even_sigma                 - significance of their difference
+        secondary_depth, secondary_snr - depth at phase 0 (= 1)
+        n_transits                     - number of transits with data
+        first_transit                  - mid-time of the first of these
+        transit_snr                    - SNR of each transit (nan padded)
+        profile                        - binned phase-folded lc
+    Without flux_err the noise is taken from the out-of-transit scatter.
+    The phase bin centres of the profiles are stored in meta['profile_phase'].
+    """
+    time, _ = _strip_unit(time)
+    flux = np.asarray(flux, dtype=float)
+    periods, _ = _strip_unit(candidates['period'])
+    t0s, _ = _strip_unit(candidates['transit_time'])
+    durations, _ = _strip_unit(candidates['duration'])
+    n_cand = len(periods)
+    w = np.ones(len(time)) if flux_err is None else 1/np.asarray(flux_err, dtype=float)**2
+
+    # Fold on all periods at once
+    cycles = (time[None,:] - t0s[:,None])/periods[:,None]
+    epoch_number = np.floor(cycles + 0.5).astype(int)
+    phase = np.mod(cycles + 0.5, 1.)
+    offset = np.abs(phase - 0.5)
+    half_width = 0.5*durations[:,None]/periods[:,None]
+    in_transit = offset < half_width
+    in_secondary = offset > 0.5 - half_width
+    out_of_transit = ~in_transit & ~in_secondary
+
+    def weighted_mean(mask):
+        sum_w = np.sum(w*mask, axis=1)
+        return np.sum(w*flux*mask, axis=1)/np.where(sum_w > 0, sum_w, np.nan), sum_w
+
+    baseline, _ = weighted_mean(out_of_transit)
+    if flux_err is None:
+        n_out = np.sum(out_of_transit, axis=1)
+        scale = np.sqrt(np.sum(((flux[None,:] - baseline[:,None])*out_of_transit)**2, axis=1)/np.maximum(n_out - 1, 1))
+    else:
+        scale = np.ones(n_cand)
+
+    def depth_and_err(mask):
+        mean, sum_w = weighted_mean(mask)
+        return baseline - mean, scale/np.sqrt(sum_w)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        depth, depth_err = depth_and_err(in_transit)
+        depth_odd, err_odd = depth_and_err(in_transit & (epoch_number % 2 == 1))
+        depth_even, err_even = depth_and_err(in_transit & (epoch_number % 2 == 0))
+        secondary_depth, secondary_err = depth_and_err(in_secondary)
+
+        # Individual transits, binned by (candidate, epoch)
+        first_epoch = np.min(np.where(in_transit, epoch_number, np.iinfo(int).max), axis=1)
+        first_epoch = np.where(np.any(in_transit, axis=1), first_epoch, 0)
+        epoch_index = epoch_number - first_epoch[:,None]
+        n_epochs = max(int(np.max(np.where(in_transit, epoch_index, 0))) + 1, 1)
+        rows = np.nonzero(in_transit)
+        flat = rows[0]*n_epochs + epoch_index[rows]
+        transit_w = np.bincount(flat, weights=w[rows[1]], minlength=n_cand*n_epochs).reshape(n_cand, n_epochs)
+        transit_wy = np.bincount(flat, weights=(w*flux)[rows[1]], minlength=n_cand*n_epochs).reshape(n_cand, n_epochs)
+        transit_depth = baseline[:,None] - transit_wy/transit_w
+        transit_snr = np.where(transit_w > 0, transit_depth*np.sqrt(transit_w)/scale[:,None], np.nan)
+
+        # Binned phase-folded profiles
+        phase_bin = np.minimum((phase*n_phase_bins).astype(int), n_phase_bins-1)
+        flat = (phase_bin + n_phase_bins*np.arange(n_cand)[:,None]).ravel()
+        bin_w = np.bincount(flat, weights=np.tile(w, n_cand), minlength=n_cand*n_phase_bins)
+        bin_wy = np.bincount(flat, weights=np.tile(w*flux, n_cand), minlength=n_cand*n_phase_bins)
+        profile = (bin_wy/bin_w).reshape(n_cand, n_phase_bins)
+
+        vetting = Table()
+        for field in ['rank', 'period', 'transit_time', 'duration']:
+            if field in candidates.colnames:
+                vetting[field] = candidates[field]
+        vetting['depth'] = depth
+        vetting['depth_err'] = depth_err
+        vetting['snr'] = depth/depth_err
+        vetting['depth_odd'] = depth_odd
+        vetting['depth_even'] = depth_even
+        vetting['odd_even_sigma'] = np.abs(depth_odd - depth_even)/np.sqrt(err_odd**2 + err_even**2)
+        vetting['secondary_depth'] = secondary_depth
+        vetting['secondary_snr'] = secondary_depth/secondary_err
+        vetting['n_transits'] = np.sum(transit_w > 0, axis=1)
+        vetting['first_transit'] = t0s + periods*first_epoch
+        vetting['transit_snr'] = transit_snr
+        vetting['profile'] = profile
+    vetting.meta['profile_phase'] = (np.arange(n_phase_bins) + 0.5)/n_phase_bins
+    return vetting
+
+def single_transit_search(time, flux, durations, cadence = None, kernel = 'box', ingress_fraction = 0.25, snr_threshold = 7., min_coverage = 0.75):
+    """
+    Matched-filter search for individual transit-like dips, for planets too
+    long period to show the three transits needed by the BLS search
+
+    The lc is put on a uniform grid (zeros in gaps, with a matching mask) and
+    correlated with a box or trapezoid ('trapezoid') kernel for each trial
+    duration by FFT, so each duration costs O(N log N). At each grid point the
+    depth is the least-squares kernel amplitude using only the points with
+    data, and the SNR uses a robust (MAD) estimate of the scatter of the
+    flux itself, which unlike the point-to-point scatter also counts any
+    residual correlated noise. Dips where less than min_coverage of the
+    kernel has data are ignored.
+    n.b. durations and cadence in days; ingress_fraction is the fraction of
+    the duration spent in each of ingress and egress for the trapezoid
+
+    Returns an astropy Table of dips above snr_threshold, separated by at
+    least the longest trial duration, strongest first
+    """
+    time, _ = _strip_unit(time)
+    flux = np.asarray(flux, dtype=float)
+    durations, _ = _strip_unit(durations)
+    good = np.isfinite(time) & np.isfinite(flux)
+    time = time[good]
+    flux = flux[good]
+    if cadence is None:
+        cadence = np.median(np.diff(time))
+
+    # Uniform grid, with the mask marking which points hold data
+    index = np.round((time - time[0])/cadence).astype(int)
+    n = index[-1] + 1
+    y = np.zeros(n)
+    mask = np.zeros(n)
+    y[index] = flux - np.median(flux)
+    mask[index] = 1.
+    sigma = 1.4826*np.median(np.abs(flux - np.median(flux)))
+    grid_time = time[0] + np.arange(n)*cadence
+
+    best_snr = np.zeros(n)
+    best_depth = np.zeros(n)
+    best_duration = np.zeros(n)
+    for duration in durations:
+        width = max(int(round(duration/cadence)), 1)
+        if kernel == 'trapezoid':
+            ramp = max(int(round(ingress_fraction*width)), 1)
+            k = np.minimum(np.minimum(np.arange(1, width+1), np.arange(width, 0, -1))/float(ramp), 1.)
+        else:
+            k = np.ones(width)
+        coverage = fftconvolve(mask, k, mode='same')/np.sum(k)
+        sum_ky = -fftconvolve(y, k, mode='same')
+        sum_kk = fftconvolve(mask, k**2, mode='same')
+        usable = (coverage >= min_coverage) & (sum_kk > 0)
+        depth = np.where(usable, sum_ky/np.where(usable, sum_kk, 1.), 0.)
+        snr = depth*np.sqrt(np.where(usable, sum_kk, 0.))/sigma
+        better = snr > best_snr
+        best_snr[better] = snr[better]
+        best_depth[better] = depth[better]
+        best_duration[better] = width*cadence
+
+    separation = max(int(round(np.max(durations)/cadence)), 1)
+    peaks = find_peaks(best_snr, height = snr_threshold, distance = separation)[0]
+    peaks = peaks[np.argsort(best_snr[peaks])[::-1]]
+
+    events = Table()
+    events['time'] = grid_time[peaks]
+    events['depth'] = best_depth[peaks]
+    events['duration'] = best_duration[peaks]
+    events['snr'] = best_snr[peaks]
+    return events
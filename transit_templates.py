@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:45:12 2026
+transit_templates.py
+
+Cached transit profiles for fast injections.
+
+For a circular orbit the shape of a transit as a function of orbital phase
+only depends on the radius ratio, a/R*, inclination and limb darkening, not
+on the period or epoch. Each such shape is computed once with batman on a
+fine phase grid covering the transit and kept in memory (the few hundred
+most recently used). An injection at any period and epoch is then an
+interpolation of the template at the phases of the in-transit cadences only.
+
+@author: mbattley
+"""
+
+import functools
+import numpy as np
+import batman
+
+# n.b. Injection grids draw rp and a/R* continuously, so keep only the most recently used templates
+TEMPLATE_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize = TEMPLATE_CACHE_SIZE)
+def _template(rp, a, inc, u, limb_dark, n_points):
+    sin_half = min((1. + rp)/(a*np.sin(np.radians(inc))), 1.)
+    phase_max = min(1.05*np.arcsin(sin_half)/(2*np.pi), 0.5)
+    phase = np.linspace(-phase_max, phase_max, n_points)
+    params = batman.TransitParams()
+    params.t0 = 0.
+    params.per = 1.
+    params.rp = rp
+    params.a = a
+    params.inc = inc
+    params.ecc = 0.
+    params.w = 90.
+    params.limb_dark = limb_dark
+    params.u = list(u)
+    try:
+        model = batman.TransitModel(params, phase)
+    except Exception as exc:
+        # n.b. batman cannot tune its integration step for very small planets; a fixed fine step is accurate to ~1e-9
+        #      (it raises a plain Exception for this, so anything else is passed on)
+        if not str(exc).startswith('Convergence failure'):
+            raise
+        model = batman.TransitModel(params, phase, fac = 1e-3)
+    return phase, model.light_curve(params)
+
+def transit_template(rp, a, inc = 90., u = (0.5, 0.1, 0.1, -0.1), limb_dark = 'nonlinear', n_points = 2001):
+    """
+    Returns (phase, flux) of the transit profile, from phase -phase_max to
+    +phase_max where phase_max is a little beyond fourth contact; computed
+    with batman on the first call for each set of parameters and kept for
+    the TEMPLATE_CACHE_SIZE most recently used
+    """
+    return _template(round(float(rp), 8), round(float(a), 6), round(float(inc), 6), tuple(np.round(u, 6)), limb_dark, n_points)
+
+def cached_light_curve(params, time):
+    """
+    Drop-in replacement for batman.TransitModel(params, time).light_curve(params)
+    using the cached template, for circular orbits (falls back to batman
+    otherwise)
+    """
+    time = np.asarray(time, dtype=float)
+    if params.ecc != 0.:
+        return batman.TransitModel(params, time).light_curve(params)
+    phase_grid, profile = transit_template(params.rp, params.a, params.inc, params.u, params.limb_dark)
+    phase = np.mod((time - params.t0)/params.per + 0.5, 1.) - 0.5
+    in_transit = np.abs(phase) < phase_grid[-1]
+    flux = np.ones(len(time))
+    flux[in_transit] = np.interp(phase[in_transit], phase_grid, profile)
+    return flux
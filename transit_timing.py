@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 10:26:41 2026
+transit_timing.py
+
+Per-transit timing for TTV analysis (see ttv_analysis.py).
+
+Each transit's mid-time is fitted to the data within a window around its
+predicted time, with a coarse chi-squared grid refined by Brent's method. The
+windows of all epochs are found at once with searchsorted on the (sorted)
+time array, and the independent transits can be shared between processes,
+with the timings, errors and fit diagnostics collected into one table.
+
+@author: mbattley
+"""
+
+import numpy as np
+import batman
+import multiprocessing as multip
+from scipy import optimize
+from astropy.table import Table
+from transit_templates import transit_template
+
+def chi_sq_t0_grid(int_time, int_flux, t0i_list, params, n_template_points = 20001):
+    """
+    Chi-squared of the data window against the transit model (as
+    scipy.stats.chisquare(int_flux, f_exp=model)) for every trial t0 at once.
+    The model is a single transit template, computed once with batman on a
+    fine phase grid, shifted to each trial t0.
+    n.b. Eccentric orbits fall back to one batman model per trial t0
+    """
+    if params.ecc != 0.:
+        calc_flux = np.empty((len(t0i_list), len(int_time)))
+        t0 = params.t0
+        for i in range(len(t0i_list)):
+            params.t0 = t0i_list[i]
+            calc_flux[i] = batman.TransitModel(params, int_time).light_curve(params)
+        params.t0 = t0
+    else:
+        phase_grid, profile = transit_template(params.rp, params.a, params.inc, params.u, params.limb_dark, n_template_points)
+        phase = np.mod((int_time[None,:] - np.asarray(t0i_list)[:,None])/params.per + 0.5, 1.) - 0.5
+        calc_flux = np.interp(phase, phase_grid, profile, left=1., right=1.)
+    return np.sum((int_flux[None,:] - calc_flux)**2/calc_flux, axis=1)
+
+def ingress_duration(params):
+    """
+    Ingress (or egress) duration (days) of a transit on a circular orbit
+    """
+    b = params.a*np.cos(np.radians(params.inc))
+    return params.per/(np.pi*params.a)*params.rp/np.sqrt(max(1 - b**2, params.rp))
+
+def total_duration(params):
+    """
+    Total transit duration (days) on a circular orbit
+    """
+    b = params.a*np.cos(np.radians(params.inc))
+    return params.per/np.pi*np.arcsin(min(np.sqrt(max((1 + params.rp)**2 - b**2, 0.))/(params.a*np.sin(np.radians(params.inc))), 1.))
+
+def fit_transit_time(int_time, int_flux, t0_guess, params, search_width, coarse_step = None, tolerance = 1e-6, flux_err = None):
+    """
+    Coarse-to-fine fit of one mid-transit time: chi-squared (as in find_ttvs)
+    on a grid with coarse_step spacing (default a tenth of the transit
+    duration) within search_width of t0_guess, then Brent's method (parabolic
+    steps with golden-section fallback) within the grid cells either side of
+    the best grid point, to 'tolerance' days.
+
+    Returns (t0, t0_err, chi_sq, n_evaluations). t0_err comes from the
+    curvature of a parabola fitted to chi-squared about the minimum; with no
+    flux_err the noise is taken from the best-fit residuals (reduced
+    chi-squared of 1).
+    n.b. chi-squared only has one minimum within about a transit duration of
+         the true time, so a coarse grid this sparse still brackets it
+    """
+    if coarse_step is None:
+        coarse_step = total_duration(params)/10.
+    t0i_list = np.arange(t0_guess-search_width, t0_guess+search_width+coarse_step, coarse_step)
+    chi_sq = chi_sq_t0_grid(int_time, int_flux, t0i_list, params)
+    best = np.argmin(chi_sq)
+    n_evaluations = len(t0i_list)
+
+    chi_sq_at = lambda t0: chi_sq_t0_grid(int_time, int_flux, np.array([t0]), params)[0]
+    low = t0i_list[max(best-1, 0)]
+    high = t0i_list[min(best+1, len(t0i_list)-1)]
+    fit = optimize.minimize_scalar(chi_sq_at, bounds=(low, high), method='bounded', options={'xatol':tolerance})
+    t0 = fit.x
+    n_evaluations += fit.nfev
+
+    # Curvature from a least-squares parabola over +/- max(1.5 cadences, half the ingress) about the minimum
+    # n.b. The unsupersampled model makes chi-squared kink each time ingress/egress crosses a data point, so a
+    #      narrower span measures the kinks rather than the overall curvature (too small errors at long cadence)
+    span = max(1.5*np.median(np.diff(int_time)), 0.5*ingress_duration(params))
+    offsets = np.linspace(-span, span, 9)
+    curvature = 2*np.polyfit(offsets, chi_sq_t0_grid(int_time, int_flux, t0 + offsets, params), 2)[0]
+    n_evaluations += len(offsets)
+    if flux_err is None:
+        variance = fit.fun/max(len(int_time) - 1, 1)
+    else:
+        # n.b. chi_sq_t0_grid is unweighted (divided by the model, ~1), so the errors enter as a mean variance
+        variance = np.mean(np.asarray(flux_err, dtype=float)**2)
+    t0_err = np.sqrt(2*variance/curvature) if curvature > 0 else np.nan
+    return t0, t0_err, fit.fun, n_evaluations
+
+def epoch_windows(time, t0s, half_width = 2.):
+    """
+    Start and end indices of the data strictly within half_width days of
+    each predicted transit time, for a sorted time array
+    """
+    t0s = np.asarray(t0s, dtype=float)
+    starts = np.searchsorted(time, t0s - half_width, side='right')
+    ends = np.searchsorted(time, t0s + half_width, side='left')
+    return starts, ends
+
+def _time_transit(job):
+    """
+    Fits one transit for parallel_ttvs
+    """
+    epoch, int_time, int_flux, int_err, t0_guess, params, search_width, coarse_step, tolerance = job
+    row = {'epoch':epoch, 't0_initial':t0_guess, 't0':np.nan, 't0_err':np.nan, 'chi_sq':np.nan,
+           'reduced_chi_sq':np.nan, 'n_points':len(int_time), 'n_evaluations':0}
+    if len(int_time) < 3:
+        return row
+    t0, t0_err, chi_sq, n_evaluations = fit_transit_time(int_time, int_flux, t0_guess, params, search_width, coarse_step, tolerance, int_err)
+    row.update({'t0':t0, 't0_err':t0_err, 'chi_sq':chi_sq, 'n_evaluations':n_evaluations})
+    if int_err is not None:
+        # n.b. chi_sq is unweighted, so divide by the mean variance for a reduced chi-squared
+        row['reduced_chi_sq'] = chi_sq/np.mean(int_err**2)/(len(int_time) - 1)
+    return row
+
+def parallel_ttvs(initial_t0is, time, flux, params, search_width, coarse_step = None, tolerance = 1e-6, flux_err = None, half_width = 2., n_workers = None):
+    """
+    Times every transit in initial_t0is (predicted mid-times) with
+    fit_transit_time, sharing the transits between n_workers processes
+    (default all cores)
+
+    Returns a table with one row per transit: epoch number, predicted and
+    fitted mid-time, timing error, O-C, chi-squared (and reduced chi-squared
+    if flux_err is given), the number of points in the window and the
+    number of chi-squared evaluations used. Transits with fewer than 3
+    points in their window are left as nan.
+    """
+    order = np.argsort(time)
+    time = np.asarray(time, dtype=float)[order]
+    flux = np.asarray(flux, dtype=float)[order]
+    if flux_err is not None:
+        flux_err = np.asarray(flux_err, dtype=float)[order]
+    initial_t0is = np.asarray(initial_t0is, dtype=float)
+    starts, ends = epoch_windows(time, initial_t0is, half_width)
+    jobs = [(n, time[starts[n]:ends[n]], flux[starts[n]:ends[n]], None if flux_err is None else flux_err[starts[n]:ends[n]],
+             initial_t0is[n], params, search_width, coarse_step, tolerance) for n in range(len(initial_t0is))]
+
+    if n_workers is None:
+        n_workers = multip.cpu_count()
+    if n_workers > 1:
+        pool = multip.Pool(n_workers)
+        rows = pool.map(_time_transit, jobs, chunksize = max(len(jobs)//(4*n_workers), 1))
+        pool.close()
+        pool.join()
+    else:
+        rows = list(map(_time_transit, jobs))
+
+    timings = Table(rows = rows, names = ['epoch','t0_initial','t0','t0_err','chi_sq','reduced_chi_sq','n_points','n_evaluations'])
+    timings['o_c'] = timings['t0'] - timings['t0_initial']
+    return timings
+
+def timing_pull_test(cadence, n_trials = 500, noise = 3e-4, seed = 0):
+    """
+    Checks the fit_transit_time errors on simulated single transits (a 1 day
+    window at the given cadence, days) of a hot Jupiter with random offsets
+    from the predicted time. Returns the standard deviation of the pulls
+    (t0 - true t0)/t0_err, which should be close to 1.
+    """
+    rng = np.random.default_rng(seed)
+    params = batman.TransitParams()
+    params.t0 = 0.
+    params.per = 3.1
+    params.rp = 0.05
+    params.a = 10.
+    params.inc = 89.5
+    params.ecc = 0.
+    params.w = 90.
+    params.limb_dark = "quadratic"
+    params.u = [0.4, 0.2]
+    pulls = np.empty(n_trials)
+    for i in range(n_trials):
+        true_t0 = rng.uniform(-0.01, 0.01)
+        time = np.arange(-0.5, 0.5, cadence) + rng.uniform(0, cadence)
+        params.t0 = true_t0
+        flux = batman.TransitModel(params, time).light_curve(params) + rng.normal(0, noise, len(time))
+        params.t0 = 0.
+        t0, t0_err, _, _ = fit_transit_time(time, flux, 0., params, 0.03, flux_err = np.full(len(time), noise))
+        pulls[i] = (t0 - true_t0)/t0_err
+    return np.std(pulls)
+
+if __name__ == '__main__':
+    for cadence in [2., 30.]:
+        print('{:.0f} min cadence: timing pull std = {:.2f}'.format(cadence, timing_pull_test(cadence/(24*60.))))
@@ -43,6 +43,7 @@ from scipy.signal import find_peaks
 from utility_belt import binned
 from scipy import interpolate
 from lowess_detrend import lowess_detrending
+from transit_timing import chi_sq_t0_grid, fit_transit_time, epoch_windows
 
 plt.rcParams.update({'figure.max_open_warning': 0})
 
@@ -87,8 +88,6 @@ def find_ttvs(initial_t0is, period, time, flux, params, search_width, step_size,
     final_t0is = [1]*len(n_list)
     final_t0i_cs = [1]*len(n_list)
     
-    num_transits_done = 0
-    
     for n in n_list:
         int_start = initial_t0is[n] - 2
         int_end = initial_t0is[n] + 2
@@ -99,36 +98,13 @@ def find_ttvs(initial_t0is, period, time, flux, params, search_width, step_size,
         
         t0i_list = np.arange(initial_t0is[n]-search_width,initial_t0is[n]+search_width,step_size)
         
-#        chi_sq_list = []   
-        
-        for i in range(len(t0i_list)):
-            params.t0 = t0i_list[i]                       #time of inferior conjunction
-        
-            m = batman.TransitModel(params, int_time)
-            calc_flux = m.light_curve(params) 
-            
-            chi_sq = scipy.stats.chisquare(int_flux, f_exp=calc_flux)
-    #        chi_sq_list.append((chi_sq[0],params.t0))
-            
-    #        plt.figure()
-    #        plt.scatter(int_time, int_flux, c='k', s=2)
-    #        plt.plot(int_time, calc_flux)
-    #        txt = "Chi-sq = {}; p-value = {}".format(chi_sq[0], chi_sq[1])
-    #        plt.annotate(
-    #                txt,
-    #                (0, 0),
-    #                xycoords="axes fraction",
-    #                xytext=(5, 5),
-    #                textcoords="offset points",
-    #                ha="left",
-    #                va="bottom",
-    #                fontsize=12,
-    #        )
-            if chi_sq[0] < final_t0i_cs[n]:
-                final_t0is[n] = params.t0
-                final_t0i_cs[n] = chi_sq[0]
-            print('Number of transits analysed (round {}) = {}'.format(run_number,num_transits_done))
-            num_transits_done += 1
+        # All trial t0s at once; keeps the first minimum, and only if below the starting value as before
+        chi_sq = chi_sq_t0_grid(int_time, int_flux, t0i_list, params)
+        best = np.argmin(chi_sq)
+        if chi_sq[best] < final_t0i_cs[n]:
+            final_t0is[n] = t0i_list[best]
+            final_t0i_cs[n] = chi_sq[best]
+        print('Number of transits analysed (round {}) = {}'.format(run_number,n+1))
     
     final_t0is = np.array(final_t0is)
     initial_t0is = np.array(initial_t0is)
@@ -137,6 +113,31 @@ def find_ttvs(initial_t0is, period, time, flux, params, search_width, step_size,
 
     return final_t0is, o_c
 
+def refine_ttvs(initial_t0is, period, time, flux, params, search_width, coarse_step = None, tolerance = 1e-6, flux_err = None, run_number = 2):
+    """
+    As find_ttvs, but each transit time is fitted with fit_transit_time to
+    'tolerance' rather than picked from a grid (coarse_step defaults to a
+    tenth of the transit duration). Returns (final_t0is, o_c, t0_errs).
+    n.b. time must be sorted. For many transits use transit_timing.parallel_ttvs
+         (from a script with a __main__ guard) to spread them over processes
+    """
+    final_t0is = np.full(len(initial_t0is), np.nan)
+    t0_errs = np.full(len(initial_t0is), np.nan)
+    
+    starts, ends = epoch_windows(time, initial_t0is)
+    for n in range(len(initial_t0is)):
+        idx = slice(starts[n], ends[n])
+        if ends[n] <= starts[n]:
+            continue
+        
+        err = None if flux_err is None else flux_err[idx]
+        final_t0is[n], t0_errs[n], _, _ = fit_transit_time(time[idx], flux[idx], initial_t0is[n], params, search_width, coarse_step, tolerance, err)
+        print('Number of transits analysed (round {}) = {}'.format(run_number,n+1))
+    
+    o_c = final_t0is - np.array(initial_t0is)
+
+    return final_t0is, o_c, t0_errs
+
 #Psudo-code:
 # Pull in random light-curve of system with known planet
 # Detrend out of transit effects - probably with Wotan, polynomial or long-window lowess
@@ -985,7 +986,9 @@ params.rp = map_soln0['r_pl_b']
 if no_TTV == True:
     final_t0is3 = initial_t0is
 else:
-    final_t0is3, o_c3 = find_ttvs(final_t0is2, periods[planet_num], time_Kepler_masked, flux_Kepler_masked, params, search_width=0.025, step_size=1/(24*60*6), run_number=3)  #10s step
+#    final_t0is3, o_c3 = find_ttvs(final_t0is2, periods[planet_num], time_Kepler_masked, flux_Kepler_masked, params, search_width=0.025, step_size=1/(24*60*6), run_number=3)  #10s step
+    # Coarse grid (a tenth of the duration) then refined to ~0.1s, with curvature-based timing errors
+    final_t0is3, o_c3, t0_errs3 = refine_ttvs(final_t0is2, periods[planet_num], time_Kepler_masked, flux_Kepler_masked, params, search_width=0.025, tolerance=1e-6, run_number=3)
 
 #Plot new fold
 folded_fig3 = plt.figure()
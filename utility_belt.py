@@ -15,7 +15,11 @@ import numpy as np
 from astropy.table import Table
 from astroquery.mast import Catalogs
 from scipy import optimize
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import find_peaks
 from astropy.timeseries import LombScargle
+from astropy.timeseries.periodograms.lombscargle.implementations.utils import trig_sum
+from stellar_params import stellar_masses_radii
 
 
 def trig_func(t,f,a,b,c):
@@ -37,17 +41,139 @@ def next_highest_freq(time, flux, freq, f_remove, plot_ls_fig = False,target_ID
     freq_2 = freq[i]
     return freq_2, flux
 
-def find_freqs(time, flux, plot_ls_fig = True, target_ID = ''):
+def fit_sinusoids(time, flux, freqs, flux_err = None):
+    """
+    Linear least-squares fit of a sum of sinusoids at fixed frequencies, i.e.
+    sum_i [a_i*sin(2 pi f_i t) + b_i*cos(2 pi f_i t)] + c
+
+    Returns arrays of a and b, the offset c and the model flux
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    arg = 2*np.pi*np.outer(time, freqs)
+    design = np.hstack((np.sin(arg), np.cos(arg), np.ones((len(time),1))))
+    if flux_err is None:
+        coeffs = np.linalg.lstsq(design, flux, rcond=None)[0]
+    else:
+        w = 1/np.asarray(flux_err)
+        coeffs = np.linalg.lstsq(design*w[:,None], flux*w, rcond=None)[0]
+    n = len(freqs)
+    model = design.dot(coeffs)
     
-    # Remove frequencies associated with 14d data gap
-    f=1/14
-    popt_sys, pcov_sys = optimize.curve_fit(lambda t, a, b, c: trig_func(t,f, a, b, c), time, flux, maxfev=1000)
-    sys_var = trig_func(time,f,*popt_sys)
-    flux = flux/sys_var
+    return coeffs[:n], coeffs[n:2*n], coeffs[-1], model
+
+def prewhiten(time, flux, freq, n_freqs = 3, flux_err = None, fixed_freqs = [], refine = True, return_power = False):
+    """
+    Finds the n_freqs strongest periodic signals in a lc by prewhitening.
+    
+    Each sinusoid is fitted as a linear least-squares problem at fixed frequency
+    and the Lomb-Scargle periodogram (floating mean) is then updated for its
+    removal using precomputed window sums, rather than being recomputed over
+    the full grid. Any fixed_freqs (e.g. 1/14 for the TESS orbit) are removed
+    before the search. If refine is True, each peak frequency is refined to
+    below the grid spacing by parabolic interpolation and all sinusoids are
+    refitted simultaneously at the refined frequencies at the end.
+    n.b. freq must be a regularly spaced grid
+    
+    Returns an astropy Table of frequencies, periods, amplitudes, phases and
+    powers and the residual flux (plus the initial periodogram if return_power)
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    freq = np.asarray(freq, dtype=float)
+    n_grid = len(freq)
+    df = (freq[-1] - freq[0])/(n_grid - 1)
+    if not np.allclose(np.diff(freq), df, rtol=1e-6, atol=0):
+        raise ValueError("freq must be a regularly spaced grid for prewhitening")
     
-     #From Lomb-Scargle
+    if flux_err is None:
+        w = np.ones_like(time)
+    else:
+        w = 1/np.asarray(flux_err, dtype=float)**2
+    w /= w.sum()
+    
+    # Remove fixed (e.g. systematic) frequencies first
+    residual = flux.copy()
+    if len(fixed_freqs) > 0:
+        residual = residual - fit_sinusoids(time, residual, fixed_freqs, flux_err)[3] + np.average(residual, weights=w)
+    base_flux = residual.copy()
+    
+    # Window sums: at the grid frequencies, at f - f0 = m*df and at f + f0 = 2f_min + m*df
+    S, C = trig_sum(time, w, df, n_grid, f0=freq[0])
+    Ws_minus, Wc_minus = trig_sum(time, w, df, n_grid, f0=0.)
+    Ws_plus, Wc_plus = trig_sum(time, w, df, 2*n_grid - 1, f0=2*freq[0])
+    SS = 0.5*(1 - Wc_plus[::2])
+    CC = 0.5*(1 + Wc_plus[::2])
+    CS = 0.5*Ws_plus[::2]
+    
+    # Data sums, which are the only ones changed by each prewhitening step
+    Ys, Yc = trig_sum(time, w*residual, df, n_grid, f0=freq[0])
+    Y = np.sum(w*residual)
+    
+    k = np.arange(n_grid)
+    found = []
+    initial_power = None
+    for n in range(n_freqs):
+        YY = np.sum(w*residual**2) - Y**2
+        YS = Ys - Y*S
+        YC = Yc - Y*C
+        SSc = SS - S*S
+        CCc = CC - C*C
+        CSc = CS - C*S
+        D = CCc*SSc - CSc**2
+        power = (SSc*YC**2 + CCc*YS**2 - 2*CSc*YC*YS)/(YY*D)
+        if initial_power is None:
+            initial_power = power
+        
+        j = np.argmax(power)
+        f_peak = freq[j]
+        if refine and 0 < j < n_grid - 1:
+            denom = power[j-1] - 2*power[j] + power[j+1]
+            if denom < 0:
+                f_peak += 0.5*df*(power[j-1] - power[j+1])/denom
+        
+        # Linear least-squares amplitudes at the grid frequency from the sums
+        normal = np.array([[SS[j], CS[j], S[j]], [CS[j], CC[j], C[j]], [S[j], C[j], 1.]])
+        a, b, c = np.linalg.solve(normal, np.array([Ys[j], Yc[j], Y]))
+        found.append([f_peak, np.hypot(a, b), np.arctan2(b, a), power[j]])
+        
+        # Remove sinusoid from data and update sums incrementally
+        arg = 2*np.pi*freq[j]*time
+        residual = residual - (a*np.sin(arg) + b*np.cos(arg) + c)
+        minus = np.abs(k - j)
+        sign = np.sign(k - j)
+        Wc_m = Wc_minus[minus]
+        Ws_m = sign*Ws_minus[minus]
+        Wc_p = Wc_plus[k + j]
+        Ws_p = Ws_plus[k + j]
+        Ys = Ys - (0.5*a*(Wc_m - Wc_p) + 0.5*b*(Ws_p + Ws_m) + c*S)
+        Yc = Yc - (0.5*a*(Ws_p - Ws_m) + 0.5*b*(Wc_m + Wc_p) + c*C)
+        Y = np.sum(w*residual)
+    
+    found = np.array(found).reshape(-1, 4)
+    freq_table = Table()
+    freq_table['frequency'] = found[:,0]
+    freq_table['period'] = 1/found[:,0]
+    freq_table['amplitude'] = found[:,1]
+    freq_table['phase'] = found[:,2]
+    freq_table['power'] = found[:,3]
+    
+    # Simultaneous fit of all refined frequencies to the (fixed-frequency removed) lc
+    if refine and n_freqs > 0:
+        a, b, c, model = fit_sinusoids(time, base_flux, freq_table['frequency'], flux_err)
+        freq_table['amplitude'] = np.hypot(a, b)
+        freq_table['phase'] = np.arctan2(b, a)
+        residual = base_flux - model
+    
+    if return_power:
+        return freq_table, residual, initial_power
+    return freq_table, residual
+
+def find_freqs(time, flux, plot_ls_fig = True, target_ID = '', n_freqs = 3):
+    
+    # Removes frequency associated with 14d data gap and then prewhitens the
+    # n_freqs strongest frequencies from the Lomb-Scargle
     freq = np.arange(0.05,4.1,0.00001)
-    power = LombScargle(time, flux).power(freq)
+    freq_table, residual_flux, power = prewhiten(time, flux, freq, n_freqs = n_freqs, fixed_freqs = [1/14], return_power = True)
     if plot_ls_fig == True:
         ls_fig = plt.figure()
         plt.plot(freq, power, c='k', linewidth = 1)
@@ -57,24 +183,170 @@ def find_freqs(time, flux, plot_ls_fig = True, target_ID = ''):
         ls_fig.show()
 #        ls_fig.savefig(save_path + '{} - Lomb-Scargle Periodogram for original lc.png'.format(target_ID))
 #        plt.close(ls_fig)
-    i = np.argmax(power)
-    freq_rot = freq[i]
+
+    freq_list = list(freq_table['frequency'])
     
-    # Remove highest frequency to get 2nd highest
-    f_remove=freq_rot
-    freq_2, flux = next_highest_freq(time, flux, freq, f_remove, plot_ls_fig = False)
-        
-    # Remove 2nd highest frequency to get 3rd highest
-    f_remove=freq_2
-    freq_3, flux = next_highest_freq(time, flux, freq, f_remove, plot_ls_fig = False)
+    return freq_list
 
-    freq_list = [freq_rot,freq_2,freq_3]
+def acf_rotation_period(time, flux, cadence = None, max_lag = None, smooth = 0.1, plot_acf = False, target_ID = ''):
+    """
+    Estimates the rotation period from the autocorrelation function (ACF) of a
+    lc, after McQuillan et al. (2013)
     
-    #final_fig = plt.figure()
-    #plt.scatter(time,flux,s=1,c='k')
-    #plt.show()
+    The lc is placed on a uniform grid (gaps filled with zeros after removing
+    the mean) and the ACF computed by FFT in O(N log N). The ACF is smoothed
+    with a Gaussian of width 'smooth' days and the period taken from the first
+    peak (or the second if it is higher, as for double-dipping stars), refined
+    using the positions of its harmonics.
+    n.b. cadence and max_lag in days; max_lag defaults to half the baseline
     
-    return freq_list
+    Returns period, local ACF peak height and period uncertainty (all nan if no
+    peak is found)
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(time) & np.isfinite(flux)
+    time = time[good]
+    flux = flux[good]
+    if cadence is None:
+        cadence = np.median(np.diff(time))
+    if max_lag is None:
+        max_lag = 0.5*(time[-1] - time[0])
+    
+    # Place data on a uniform grid, leaving zeros in the gaps
+    index = np.round((time - time[0])/cadence).astype(int)
+    n = index[-1] + 1
+    grid_flux = np.zeros(n)
+    grid_flux[index] = flux - np.mean(flux)
+    
+    # ACF via FFT, zero-padded to avoid wrap-around
+    n_fft = 2**int(np.ceil(np.log2(2*n)))
+    f_flux = np.fft.rfft(grid_flux, n_fft)
+    n_lags = min(int(max_lag/cadence), n - 1)
+    acf = np.fft.irfft(f_flux*np.conj(f_flux), n_fft)[:n_lags]
+    acf /= acf[0]
+    lags = np.arange(n_lags)*cadence
+    
+    smooth_acf = gaussian_filter1d(acf, max(smooth/cadence, 1.))
+    peaks = find_peaks(smooth_acf)[0]
+    troughs = find_peaks(-smooth_acf)[0]
+    if plot_acf == True:
+        acf_fig = plt.figure()
+        plt.plot(lags, acf, c='grey', linewidth = 1)
+        plt.plot(lags, smooth_acf, c='k', linewidth = 1)
+        plt.xlabel('Lag [days]')
+        plt.ylabel('ACF')
+        plt.title('{} ACF'.format(target_ID))
+        acf_fig.show()
+    if len(peaks) == 0:
+        return np.nan, np.nan, np.nan
+    
+    # Local peak heights, relative to the mean of the troughs either side
+    trough_lags = np.concatenate(([0], troughs, [n_lags - 1]))
+    i = np.searchsorted(trough_lags, peaks)
+    heights = smooth_acf[peaks] - 0.5*(smooth_acf[trough_lags[i-1]] + smooth_acf[trough_lags[i]])
+    
+    first = 0
+    if len(peaks) > 1 and heights[1] > heights[0]:
+        first = 1
+    period = lags[peaks[first]]
+    
+    # Refine with peaks lying near integer multiples of the first estimate
+    multiples = np.round(lags[peaks]/period)
+    harmonic = (multiples >= 1) & (np.abs(lags[peaks] - multiples*period) < 0.2*period)
+    estimates = lags[peaks][harmonic]/multiples[harmonic]
+    if len(estimates) > 1:
+        period = np.median(estimates)
+        period_err = 1.483*np.median(np.abs(estimates - period))/np.sqrt(len(estimates) - 1)
+        period_err = max(period_err, cadence)
+    else:
+        # Half width at half maximum of the peak
+        half = smooth_acf[peaks[first]] - 0.5*heights[first]
+        above = smooth_acf > half
+        lo = peaks[first]
+        while lo > 0 and above[lo]:
+            lo -= 1
+        hi = peaks[first]
+        while hi < n_lags - 1 and above[hi]:
+            hi += 1
+        period_err = 0.5*(hi - lo)*cadence
+    
+    return period, heights[first], period_err
+
+def pdm_batch(times, fluxes, periods, n_bins = 10, max_elements = 2*10**7):
+    """
+    Phase Dispersion Minimization (Stellingwerf 1978) theta statistic for
+    several lcs at once on a common period grid
+    
+    For each chunk of periods every point of every star is assigned a single
+    (star, period, phase bin) index, so the bin counts, sums and sums of
+    squares of all stars come from three bincounts. The number of periods per
+    chunk is set so that the temporary (period x point) arrays hold at most
+    max_elements values in total. Bins with fewer than two points are ignored.
+    
+    Returns theta with shape (number of stars, number of periods)
+    """
+    periods = np.asarray(periods, dtype=float)
+    n_stars = len(times)
+    time = np.concatenate([np.asarray(t, dtype=float) for t in times])
+    star = np.concatenate([np.full(len(t), i) for i, t in enumerate(times)])
+    
+    # Standardise each lc so the sums are well conditioned
+    y = np.concatenate([(np.asarray(f, dtype=float) - np.mean(f))/np.std(f) for f in fluxes])
+    n_points = np.bincount(star, minlength=n_stars)
+    total_var = np.bincount(star, weights=y**2, minlength=n_stars)/(n_points - 1)
+    
+    theta = np.zeros((n_stars, len(periods)))
+    # n.b. Each chunk holds about six (period x point) arrays at once: the phases, their
+    #      mod, the bin indices, the flat indices and the two tiled weights
+    chunk_size = max(int(max_elements//(6*len(time))), 1)
+    for start in range(0, len(periods), chunk_size):
+        p = periods[start:start+chunk_size]
+        phase = np.mod(time[None,:]/p[:,None], 1.)
+        bins = np.minimum((phase*n_bins).astype(int), n_bins-1)
+        flat = ((star[None,:]*len(p) + np.arange(len(p))[:,None])*n_bins + bins).ravel()
+        size = n_stars*len(p)*n_bins
+        n = np.bincount(flat, minlength=size).reshape(n_stars, len(p), n_bins)
+        sum_y = np.bincount(flat, weights=np.tile(y, len(p)), minlength=size).reshape(n_stars, len(p), n_bins)
+        sum_yy = np.bincount(flat, weights=np.tile(y**2, len(p)), minlength=size).reshape(n_stars, len(p), n_bins)
+        used = n > 1
+        within = np.sum(np.where(used, sum_yy - sum_y**2/np.where(used, n, 1), 0.), axis=2)
+        dof = np.sum(np.where(used, n, 0), axis=2) - np.sum(used, axis=2)
+        theta[:,start:start+len(p)] = within/dof/total_var[:,None]
+    return theta
+
+def pdm_periodogram(time, flux, periods, n_bins = 10, max_elements = 2*10**7):
+    """
+    PDM theta statistic of a single lc at each trial period
+    """
+    return pdm_batch([time], [flux], periods, n_bins, max_elements)[0]
+
+def pdm_rotation_period(time, flux, min_period = 0.1, max_period = None, n_periods = 20000, n_bins = 25, plot_pdm = False, target_ID = ''):
+    """
+    Period of minimum phase dispersion, for eclipsing binaries and strongly
+    non-sinusoidal rotators where the highest LS peak is often a harmonic
+    n.b. Periods in days; max_period defaults to half the baseline. Trial
+    periods are evenly spaced in frequency. Fine phase bins are needed to
+    resolve eclipses, otherwise half the binary period is often preferred.
+    
+    Returns period and its theta (0 = perfectly periodic, ~1 = no signal)
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(time) & np.isfinite(flux)
+    if max_period is None:
+        max_period = 0.5*(np.max(time[good]) - np.min(time[good]))
+    periods = 1/np.linspace(1/max_period, 1/min_period, n_periods)
+    theta = pdm_periodogram(time[good], flux[good], periods, n_bins)
+    if plot_pdm == True:
+        pdm_fig = plt.figure()
+        plt.plot(periods, theta, c='k', linewidth = 1)
+        plt.xlabel('Period [days]')
+        plt.ylabel('Theta')
+        plt.title('{} PDM Periodogram'.format(target_ID))
+        pdm_fig.show()
+    i = np.argmin(theta)
+    return periods[i], theta[i]
 
 def tic_stellar_info(target_ID, from_file = False, filename = 'BANYAN_XI-III_members_with_TIC.csv'):
     if from_file == True:
@@ -96,6 +368,15 @@ def tic_stellar_info(target_ID, from_file = False, filename = 'BANYAN_XI-III_mem
     
     return tic, r_star, T_eff
 
+def stellar_mass_radius(target_ID, filename = 'BANYAN_XI-III_members_with_TIC.csv'):
+    """
+    Obtains stellar mass and radius (in solar units) for a target from the
+    BANYAN table. n.b. Returns nan for both if the target is not in the table
+    n.b. The table is read and indexed once per process (see stellar_params)
+    """
+    m_star, r_star = stellar_masses_radii([target_ID], filename)
+    return float(m_star[0]), float(r_star[0])
+
 def planet_size_from_depth(target_ID, depth):
     tic, r_star, T_eff = tic_stellar_info(target_ID)
     
@@ -167,6 +448,43 @@ def bin(time, flux, binsize=15, method='mean'):
 
     return binned_time, binned_flux
 
+def search_cadence(min_duration, points_per_duration = 4):
+    """
+    Cadence (days) to bin a lc to before searching for transits no shorter
+    than min_duration (days), keeping points_per_duration points across them
+    """
+    return min_duration/points_per_duration
+
+def bin_by_time(time, flux, cadence, flux_err = None):
+    """
+    Bins a lc onto a fixed time grid of spacing 'cadence' (days) in one pass
+    
+    Bins are weighted means, placed at the mean time of the points they
+    contain, and empty bins are dropped. Errors are 1/sqrt(sum of weights) if
+    flux_err is given, otherwise the point-to-point scatter (from the MAD of
+    successive differences) divided by sqrt(number of points in the bin).
+    
+    Returns binned_time, binned_flux, binned_err
+    """
+    time = np.asarray(time, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if flux_err is None:
+        w = np.ones(len(time))
+    else:
+        w = 1/np.asarray(flux_err, dtype=float)**2
+    index = np.floor((time - time[0])/cadence).astype(int)
+    sum_w = np.bincount(index, weights=w)
+    used = sum_w > 0
+    sum_w = sum_w[used]
+    binned_time = np.bincount(index, weights=w*time)[used]/sum_w
+    binned_flux = np.bincount(index, weights=w*flux)[used]/sum_w
+    if flux_err is None:
+        sigma = 1.4826*np.median(np.abs(np.diff(flux) - np.median(np.diff(flux))))/np.sqrt(2)
+        binned_err = sigma/np.sqrt(sum_w)
+    else:
+        binned_err = 1/np.sqrt(sum_w)
+    return binned_time, binned_flux, binned_err
+
 def phase_fold_plot(t, lc, period, epoch, target_ID, save_path, title, binned = True, n_bins=15):
     """
     Phase-folds the lc by the given period, and plots a phase-folded light-curve